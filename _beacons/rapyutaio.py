@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+"""
+Fire events when Rapyuta IO resources change, so reactors can respond
+without polling the API themselves.
+
+Each poll fetches each watched listing once and compares it with the
+previous poll. An event is only fired for the resources that changed:
+
+	salt/beacon/<minion id>/rapyutaio/deployment/<name>/phase
+	salt/beacon/<minion id>/rapyutaio/device/<name>/changed
+
+.. code-block:: yaml
+
+	beacons:
+	  rapyutaio:
+	    - interval: 30
+	    - deployments: True
+	    - devices: True
+	    - emitatstartup: False
+"""
+import logging
+import zlib
+import salt.utils.beacons
+
+
+
+log = logging.getLogger(__name__)
+
+
+
+__virtualname__ = "rapyutaio"
+
+# Phases requested from the deployment listing, so that deployments which
+# fail or stop are reported rather than disappearing from the listing
+DEPLOYMENT_PHASES = [
+	'In progress',
+	'Provisioning',
+	'Succeeded',
+	'Failed to start',
+	'Partially deprovisioned',
+	'Deployment stopped',
+]
+
+# (name, phase, status) of each deployment at the last poll, keyed by
+# deployment ID, as a stopped and a running deployment can share a name
+LAST_DEPLOYMENTS = None
+
+# Fingerprint of each device at the last poll, keyed by UUID. Only the
+# status and checksums of the labels and config variables are kept, so
+# the snapshot stays small however large the fleet is.
+LAST_DEVICES = None
+
+
+
+def __virtual__():
+	return __virtualname__
+
+
+
+def validate(config):
+	"""
+	Validate the beacon configuration
+	"""
+	if not isinstance(config, list):
+		return False, "Configuration for rapyutaio beacon must be a list."
+
+	config = salt.utils.beacons.list_to_dict(config)
+
+	for option in ("deployments", "devices", "emitatstartup"):
+		if not isinstance(config.get(option, True), bool):
+			return False, "rapyutaio beacon option '{0}' must be True or False.".format(option)
+
+	return True, "Valid beacon configuration"
+
+
+
+def _poll(resource):
+	"""
+	Make sure the listing of a resource is revalidated with the API rather
+	than served from the listing cache. Beacons aren't given ``__utils__``,
+	so this goes through the execution module.
+	"""
+	__salt__['rapyutaio.cache_invalidate'](resource)
+
+
+
+def _deployment_events(emitatstartup):
+	"""
+	Return an event for each deployment whose phase or status changed since
+	the last poll, including deployments that are gone
+	"""
+	global LAST_DEPLOYMENTS
+
+	_poll("deployments")
+	deployments = __salt__['rapyutaio.get_deployments'](phase=DEPLOYMENT_PHASES)
+
+	if deployments is None:
+		# Keep the last snapshot and try again on the next poll
+		return []
+
+	current = {
+		deployment['deploymentId']: (deployment['name'],
+		                             deployment.get('phase'),
+		                             deployment.get('status'))
+		for deployment
+		in deployments
+	}
+
+	if LAST_DEPLOYMENTS is None:
+		previous = {} if emitatstartup else current
+	else:
+		previous = LAST_DEPLOYMENTS
+	LAST_DEPLOYMENTS = current
+
+	events = []
+	for deployment_id in set(current) | set(previous):
+		new = current.get(deployment_id)
+		old = previous.get(deployment_id)
+
+		if new == old:
+			continue
+
+		name = (new or old)[0]
+		events.append({
+			"tag": "deployment/{0}/phase".format(name),
+			"name": name,
+			"deploymentId": deployment_id,
+			"phase": new[1] if new else None,
+			"status": new[2] if new else None,
+			"old_phase": old[1] if old else None,
+			"old_status": old[2] if old else None,
+		})
+
+	return events
+
+
+
+def _checksum(key_values):
+	"""
+	CRC32 of a list of key/value dicts, independent of their order
+	"""
+	return zlib.crc32("\n".join(sorted(
+		"{0}={1}".format(key_value['key'], key_value['value'])
+		for key_value
+		in key_values or []
+	)).encode("utf-8"))
+
+
+
+def _device_fingerprint(device):
+	"""
+	Compact summary of the parts of a device that targeting depends on
+	"""
+	return (
+		device['name'],
+		device.get('status'),
+		_checksum(device.get('labels')),
+		_checksum(device.get('config_variables')),
+	)
+
+
+
+def _device_events(emitatstartup):
+	"""
+	Return an event for each device whose name, status, labels or config
+	variables changed since the last poll, including devices that are gone
+	"""
+	global LAST_DEVICES
+
+	_poll("devices")
+	devices = __salt__['rapyutaio.get_devices']()
+
+	if devices is None:
+		# Keep the last snapshot and try again on the next poll
+		return []
+
+	current = {
+		device['uuid']: _device_fingerprint(device)
+		for device
+		in devices
+	}
+
+	if LAST_DEVICES is None:
+		previous = {} if emitatstartup else current
+	else:
+		previous = LAST_DEVICES
+	LAST_DEVICES = current
+
+	events = []
+	for uuid in set(current) | set(previous):
+		new = current.get(uuid)
+		old = previous.get(uuid)
+
+		if new == old:
+			continue
+
+		name = (new or old)[0]
+		events.append({
+			"tag": "device/{0}/changed".format(name),
+			"name": name,
+			"uuid": uuid,
+			"status": new[1] if new else None,
+			"old_status": old[1] if old else None,
+			"labels_changed": new is None or old is None or new[2] != old[2],
+			"config_variables_changed": new is None or old is None or new[3] != old[3],
+			"removed": new is None,
+		})
+
+	return events
+
+
+
+def beacon(config):
+	"""
+	Poll Rapyuta IO and fire events for the resources that changed.
+
+	deployments
+		Watch the phase and status of deployments. Default ``True``.
+
+	devices
+		Watch the status, labels and config variables of devices. Default
+		``False``.
+
+	emitatstartup
+		Fire events for every resource on the first poll after the minion
+		starts, instead of only recording them. Default ``False``.
+	"""
+	config = salt.utils.beacons.list_to_dict(config)
+	emitatstartup = config.get("emitatstartup", False)
+
+	events = []
+
+	if config.get("deployments", True):
+		events.extend(_deployment_events(emitatstartup))
+
+	if config.get("devices", False):
+		events.extend(_device_events(emitatstartup))
+
+	return events
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+Keep a continuously refreshed mirror of a Rapyuta IO project and serve it
+to the rapyutaio execution module over a local Unix socket.
+
+Each listing (packages, networks, deployments, devices) is refreshed on
+its own interval, with the first refreshes staggered so they don't all
+hit the API at once. While the engine runs, listing reads in the
+execution module are answered from the mirror, and when the caller
+already holds the current listing only its digest is exchanged.
+
+Writes made through the execution module invalidate the mirrored listing
+they affect, which is then refreshed straight away.
+
+.. code-block:: yaml
+
+	engines:
+	  - rapyutaio:
+	      refresh:
+	        catalog: 300
+	        networks: 60
+	        deployments: 30
+	        # don't mirror the devices
+	        devices: 0
+"""
+import logging
+import os
+import socketserver
+import threading
+import salt.utils.json
+
+
+
+log = logging.getLogger(__name__)
+
+
+
+__virtualname__ = "rapyutaio"
+
+# Default seconds between refreshes of each listing
+REFRESH = {
+	"catalog": 300,
+	"networks": 60,
+	"deployments": 30,
+	"devices": 30,
+}
+
+# Execution functions that fetch each listing with its default arguments,
+# so the mirrored listings are the ones the execution module asks for
+FETCH = {
+	"catalog": "rapyutaio.get_packages",
+	"networks": "rapyutaio.get_networks",
+	"deployments": "rapyutaio.get_deployments",
+	"devices": "rapyutaio.get_devices",
+}
+
+
+
+def __virtual__():
+	return __virtualname__
+
+
+
+def _refresh_loop(resource, interval, delay, wake):
+	"""
+	Refresh one listing every ``interval`` seconds, or as soon as it is
+	invalidated
+	"""
+	wake.wait(delay)
+
+	while True:
+		wake.clear()
+
+		# Revalidate with the API rather than reuse the cached listing
+		__utils__['rapyutaio.cache_invalidate'](resource, everywhere=False)
+		try:
+			__salt__[FETCH[resource]]()
+		except Exception as e:
+			log.exception("rapyutaio engine could not refresh {0}: {1}".format(resource, e))
+
+		wake.wait(interval)
+
+
+
+class _MirrorHandler(socketserver.StreamRequestHandler):
+	"""
+	Answers one request per connection. Requests are a JSON object, either
+	``{"get": <key>, "digest": <digest>}`` or ``{"invalidate": <resource>}``.
+	A listing is sent back as its digest, a newline, and its JSON body.
+	"""
+	def handle(self):
+		try:
+			request = salt.utils.json.loads(self.rfile.read())
+		except ValueError:
+			return
+
+		if "invalidate" in request:
+			resource = request['invalidate']
+			__utils__['rapyutaio.cache_invalidate'](resource, everywhere=False)
+			if resource in self.server.wake:
+				self.server.wake[resource].set()
+			return
+
+		listing = __utils__['rapyutaio.mirror_lookup'](request.get('get'), request.get('digest'))
+		if listing is not None:
+			digest, body = listing
+			self.wfile.write(digest.encode() + b"\n" + body)
+
+
+
+def start(refresh=None):
+	"""
+	Start refreshing the mirrored listings and serve them
+
+	refresh
+		Seconds between refreshes of each listing. A listing left out is
+		refreshed on its default interval from ``REFRESH``; set it to 0 or
+		null to not mirror it.
+	"""
+	intervals = dict(REFRESH)
+	intervals.update(refresh or {})
+	intervals = {
+		resource: interval
+		for resource, interval
+		in intervals.items()
+		if resource in FETCH and interval
+	}
+
+	__utils__['rapyutaio.mirror_serve']()
+
+	path = __utils__['rapyutaio.mirror_socket_path']()
+	os.makedirs(os.path.dirname(path), exist_ok=True)
+	if os.path.exists(path):
+		os.unlink(path)
+
+	server = socketserver.ThreadingUnixStreamServer(path, _MirrorHandler)
+	server.daemon_threads = True
+	server.wake = {}
+	os.chmod(path, 0o600)
+
+	for position, (resource, interval) in enumerate(sorted(intervals.items())):
+		server.wake[resource] = threading.Event()
+		threading.Thread(target=_refresh_loop,
+		                 name="rapyutaio-mirror-{0}".format(resource),
+		                 args=(resource,
+		                       interval,
+		                       # Spread the first refreshes over a few seconds
+		                       position * 2,
+		                       server.wake[resource]),
+		                 daemon=True).start()
+
+	try:
+		server.serve_forever()
+	finally:
+		server.server_close()
+		if os.path.exists(path):
+			os.unlink(path)
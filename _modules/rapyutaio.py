@@ -1,9 +1,11 @@
 import os
 import copy
+import hashlib
 import logging
+import concurrent.futures
 from urllib.parse import urlencode
 from enum import Enum
-from time import sleep
+from time import monotonic, sleep
 
 from salt.exceptions import CommandExecutionError, SaltInvocationError
 import salt.utils.http
@@ -50,6 +52,30 @@ POSITIVE_PHASES = [
 	Phase.SUCCEEDED,
 ]
 
+POSITIVE_PHASE_NAMES = frozenset(str(pp) for pp in POSITIVE_PHASES)
+
+# Parsers for manifest sources, by file extension. Sources with any other
+# extension are tried as YAML, which also accepts JSON.
+MANIFEST_PARSERS = {
+	".json": "json.loads",
+	".yaml": "yaml.safe_load",
+	".yml": "yaml.safe_load",
+}
+
+# Seconds between checks while waiting for deployments to be removed,
+# doubling from the first value up to the second
+DEPROVISION_POLL_INTERVAL = (2, 30)
+
+# Default seconds delete_deployments() waits for a whole teardown
+DEPROVISION_TIMEOUT = 600
+
+# Default seconds create_deployment() waits for a deployment to start,
+# unless rapyutaio:provision_timeout is set
+PROVISION_TIMEOUT = 1800
+
+# Most requests a bulk operation sends at once
+MAX_CONCURRENT_REQUESTS = 8
+
 class Status(Enum):
 	def __str__(self):
 		return str(self.value)
@@ -61,6 +87,14 @@ class Status(Enum):
 	STOPPED = 'Stopped'
 
 
+# Provisioning plans compiled by _compile_plan(), keyed by
+# (package guid, plan id), and the ID of the first plan of each package.
+# Packages can't be changed once uploaded so these never go stale.
+PLANS = {}
+DEFAULT_PLANS = {}
+
+
+
 __virtual_name__ = "rapyutaio"
 def __virtual__():
 	return __virtual_name__
@@ -89,11 +123,194 @@ def _get_config(project_id, auth_token):
 
 
 
+def _name_index(resource, listing, phase):
+	"""
+	Return a dict of the items in a listing with a positive phase, keyed
+	by name. The first item is kept when several share a name.
+
+	The index is reused for as long as the listing is the same object.
+	"""
+	def build(listing):
+		index = {}
+		for item in listing:
+			if phase(item) in POSITIVE_PHASE_NAMES:
+				index.setdefault(item['name'], item)
+		return index
+
+	return __utils__['rapyutaio.listing_index'](resource, listing, build)
+
+
+
+def _resolve_networks(names, project_id=None, auth_token=None):
+	"""
+	Look up active routed networks by name from a single listing.
+
+	Returns a dict of name to network for the names that were found
+	"""
+	index = _name_index("networks",
+	                    _list_networks(project_id=project_id,
+	                                   auth_token=auth_token),
+	                    lambda network: network['internalDeploymentStatus']['phase'])
+
+	return {
+		name: index[name]
+		for name
+		in names
+		if name in index
+	}
+
+
+
+def _resolve_deployments(names, project_id=None, auth_token=None):
+	"""
+	Look up active deployments by name from a single listing.
+
+	Returns a dict of name to deployment summary for the names that
+	were found
+	"""
+	deployments = get_deployments(project_id=project_id,
+	                              auth_token=auth_token)
+
+	if deployments is None:
+		__utils__['rapyutaio.deadline_check']("listing deployments")
+		raise CommandExecutionError("Could not list deployments")
+
+	index = _name_index("deployments",
+	                    deployments,
+	                    lambda deployment: deployment['phase'])
+
+	return {
+		name: index[name]
+		for name
+		in names
+		if name in index
+	}
+
+
+
+def cache_invalidate(resource):
+	"""
+	Mark the cached listings of a resource as stale so that the next read
+	revalidates them with rapyuta.io
+
+	CLI Example:
+
+	.. code-block:: bash
+
+		salt-call rapyutaio.cache_invalidate deployments
+	"""
+	__utils__['rapyutaio.cache_invalidate'](resource)
+	return True
+
+
+
 # -----------------------------------------------------------------------------
 #
 # Packages
 #
 # -----------------------------------------------------------------------------
+def _strip_version(version):
+	"""
+	Need to accept version with and without the 'v' prefix
+	"""
+	if version[:1] == 'v':
+		return version[1:]
+	return version
+
+
+
+def _find_package_guid(name,
+                       version,
+                       project_id=None,
+                       auth_token=None):
+	"""
+	Look up the guid of a package by name and version from the catalog
+	listing, or return None
+	"""
+	packages = get_packages(project_id=project_id,
+	                        auth_token=auth_token)
+
+	if packages is None:
+		__utils__['rapyutaio.deadline_check']("listing packages")
+		raise CommandExecutionError("Could not list packages")
+
+	def build(packages):
+		index = {}
+		for pkg_summary in packages:
+			# Keep the first package that matches the version
+			index.setdefault(
+				(pkg_summary['name'], _strip_version(pkg_summary['metadata']['packageVersion'])),
+				pkg_summary['id']
+			)
+		return index
+
+	index = __utils__['rapyutaio.listing_index']("catalog", packages, build)
+	return index.get((name, _strip_version(version)))
+
+
+
+def _compile_plan(guid,
+                  plan_id=None,
+                  project_id=None,
+                  auth_token=None):
+	"""
+	Return the provisioning plan of a package, compiled once per package
+	and plan into its ID and, for each component, its ID and a dict of
+	parameter defaults.
+
+	Uses the package's first plan if no ``plan_id`` is given.
+	"""
+	if plan_id is None:
+		plan_id = DEFAULT_PLANS.get(guid)
+
+	if (guid, plan_id) not in PLANS:
+		package = get_package(guid=guid,
+		                      project_id=project_id,
+		                      auth_token=auth_token)
+
+		if not package:
+			raise CommandExecutionError(
+				"Could not find package '{0}'".format(guid)
+			)
+
+		for plan in package['packageInfo']['plans']:
+			component_ids = {
+				internal_component['componentName']: internal_component['componentId']
+				for internal_component
+				in plan['internalComponents']
+			}
+
+			PLANS[(guid, plan['planId'])] = {
+				"plan_id": plan['planId'],
+				"components": [
+					{
+						"name": component['name'],
+						"id": component_ids[component['name']],
+						"defaults": {
+							pkg_parameter['name']: pkg_parameter.get('default', None)
+							for pkg_parameter
+							in component['parameters']
+						},
+					}
+					for component
+					in plan['components']['components']
+				],
+			}
+
+		DEFAULT_PLANS[guid] = package['packageInfo']['plans'][0]['planId']
+
+		if plan_id is None:
+			plan_id = DEFAULT_PLANS[guid]
+
+	try:
+		return PLANS[(guid, plan_id)]
+	except KeyError:
+		raise CommandExecutionError(
+			"Package '{0}' has no plan '{1}'".format(guid, plan_id)
+		)
+
+
+
 def get_packages(phase=(),
                  project_id=None,
                  auth_token=None):
@@ -130,7 +347,8 @@ def get_packages(phase=(),
 		response_body = __utils__['rapyutaio.api_request'](url=url,
 		                                                   http_method="GET",
 		                                                   project_id=project_id,
-		                                                   auth_token=auth_token)
+		                                                   auth_token=auth_token,
+		                                                   cache="catalog")
 	except CommandExecutionError as e:
 		log.exception(e)
 		return None
@@ -140,6 +358,25 @@ def get_packages(phase=(),
 
 
 
+def get_package_guid(name,
+                     version,
+                     project_id=None,
+                     auth_token=None):
+	"""
+	Get the guid of a package from the catalog listing, without fetching
+	the package itself
+	"""
+	try:
+		return _find_package_guid(name,
+		                          version,
+		                          project_id=project_id,
+		                          auth_token=auth_token)
+	except CommandExecutionError as e:
+		log.exception(e)
+		return None
+
+
+
 def get_package(name=None,
                 version=None,
                 guid=None,
@@ -182,24 +419,10 @@ def get_package(name=None,
 		#
 		# Fetch a single package via its name and version
 		#
-		packages = get_packages(project_id=project_id,
-		                        auth_token=auth_token)
-
-		# Need to accept version with and without the 'v' prefix
-		if version[0] == 'v':
-			version = version[1:]
-
-		# Return the first package that matches the version
-		for pkg_summary in packages:
-			pkg_version = pkg_summary['metadata']['packageVersion']
-
-			if pkg_version[0] == 'v':
-				pkg_version = pkg_version[1:]
-
-			if pkg_summary['name'] == name:
-				if pkg_version == version:
-					guid = pkg_summary['id']
-					break
+		guid = _find_package_guid(name,
+		                          version,
+		                          project_id=project_id,
+		                          auth_token=auth_token)
 
 	if guid is None:
 		return False
@@ -267,7 +490,8 @@ def delete_package(name=None,
 		                                   http_method="DELETE",
 		                                   params=data,
 		                                   project_id=project_id,
-		                                   auth_token=auth_token)
+		                                   auth_token=auth_token,
+		                                   invalidate="catalog")
 	except CommandExecutionError as e:
 		log.exception(e)
 		return False
@@ -276,6 +500,103 @@ def delete_package(name=None,
 
 
 
+def _get_file_str(source, saltenv):
+	"""
+	Return the contents of a manifest source
+	"""
+	contents = __salt__['cp.get_file_str'](source, saltenv=saltenv)
+
+	if contents is False:
+		raise CommandExecutionError(
+			"File '{}' does not exist".format(source)
+		)
+
+	return contents
+
+
+
+def load_manifest(source,
+                  template=None,
+                  defaults=None,
+                  context=None,
+                  saltenv="base",
+                  cache=True):
+	"""
+	Fetch, render and parse a package manifest source.
+
+	Parsed manifests are cached under the hash of the source file and of the
+	template, defaults, context and saltenv, so an unchanged source is
+	neither fetched nor rendered again. Anything else a template reads, such as pillar or
+	grains, is not part of the key: pass it in ``context`` or set
+	``cache=False``.
+
+	Sources cp.hash_file can't hash, such as ``https://`` or ``s3://``
+	URLs, are fetched every time and cached under the hash of their
+	contents, which still saves rendering and parsing them again.
+
+	CLI Example:
+
+	.. code-block:: bash
+
+		salt myproxy rapyutaio.load_manifest salt://packages/talker.yaml
+	"""
+	contents = None
+	source_hash = __salt__['cp.hash_file'](source, saltenv)
+
+	if not source_hash:
+		contents = _get_file_str(source, saltenv)
+		source_hash = {
+			"hash_type": "sha256",
+			"hsum": hashlib.sha256(contents.encode("utf-8")).hexdigest(),
+		}
+
+	key = hashlib.sha1(salt.utils.json.dumps([
+		source_hash['hash_type'],
+		source_hash['hsum'],
+		template,
+		defaults,
+		context,
+		saltenv,
+	], sort_keys=True, default=repr).encode("utf-8")).hexdigest()
+
+	if cache:
+		manifest = __utils__['rapyutaio.manifest_cache_get'](key)
+		if manifest is not None:
+			return manifest
+
+	if contents is None:
+		contents = _get_file_str(source, saltenv)
+
+	if template is not None:
+		contents = __salt__["file.apply_template_on_contents"](
+			contents, template, context, defaults, saltenv
+		)
+
+	# Look through a template extension, e.g. "talker.yaml.j2"
+	path, file_extension = os.path.splitext(source.split("?")[0])
+	if template is not None and file_extension.lower() not in MANIFEST_PARSERS:
+		_, file_extension = os.path.splitext(path)
+	parser = MANIFEST_PARSERS.get(file_extension.lower(), "yaml.safe_load")
+
+	try:
+		manifest = __utils__[parser](contents)
+	except Exception:
+		raise SaltInvocationError(
+			"Manifest source must be a JSON or YAML file"
+		)
+
+	if not isinstance(manifest, dict):
+		raise SaltInvocationError(
+			"Manifest source must be a JSON or YAML file"
+		)
+
+	if cache:
+		__utils__['rapyutaio.manifest_cache_set'](key, manifest)
+
+	return manifest
+
+
+
 def create_package(source=None,
                    manifest=None,
                    project_id=None,
@@ -289,24 +610,7 @@ def create_package(source=None,
 				"create_or_update_package requires either source or manifest"
 			)
 
-		file_name = __salt__["cp.cache_file"](source)
-
-		if file_name is not False:
-			with __utils__['files.fopen'](file_name, "r") as _f:
-				file_name_part, file_extension = os.path.splitext(file_name)
-
-				if file_extension == '.json':
-					manifest = __utils__['json.load'](_f)
-				elif file_extension in ['.yaml', '.yml']:
-					manifest = __utils__['yaml.load'](_f)
-				else:
-					raise SaltInvocationError(
-						"Source file must be a JSON (.json) or YAML (.yaml, .yml) file"
-					)
-		else:
-			raise CommandExecutionError(
-				"File '{}' does not exist".format(file_name)
-			)
+		manifest = load_manifest(source)
 
 	url = CATALOG_HOST + "/serviceclass/add"
 	try:
@@ -314,29 +618,173 @@ def create_package(source=None,
 		                                          http_method="POST",
 		                                          data=manifest,
 		                                          project_id=project_id,
-		                                          auth_token=auth_token)
+		                                          auth_token=auth_token,
+		                                          invalidate="catalog")
 	except CommandExecutionError as e:
 		log.exception(e)
 		return False
 
 
 
+def _package_label(manifest):
+	return "{0} {1}".format(manifest['name'], manifest['packageVersion'])
+
+
+
+def plan_packages(manifests,
+                  project_id=None,
+                  auth_token=None):
+	"""
+	Compare package manifests with one snapshot of the catalog.
+
+	Returns a dict keyed by "<name> <version>" with the ``action`` each
+	manifest needs, ``create``, ``replace`` or ``unchanged``, and the
+	``guid`` of the package it matches. Manifests are compared with the
+	catalog's by content hash.
+
+	Raises CommandExecutionError if several manifests are the same package,
+	or the manifest of a package in the catalog could not be fetched.
+	"""
+	guids = {}
+	for manifest in manifests:
+		label = _package_label(manifest)
+		if label in guids:
+			raise CommandExecutionError("Several manifests for package '{0}'".format(label))
+		guids[label] = _find_package_guid(manifest['name'],
+		                                  manifest['packageVersion'],
+		                                  project_id=project_id,
+		                                  auth_token=auth_token)
+
+	existing = get_manifests([guid for guid in guids.values() if guid is not None],
+	                         project_id=project_id,
+	                         auth_token=auth_token)
+
+	# A package we can't compare isn't one to create, that would conflict
+	unknown = sorted(label for label, guid in guids.items() if guid is not None and existing[guid] is None)
+	if unknown:
+		__utils__['rapyutaio.deadline_check']("getting package manifests")
+		raise CommandExecutionError("Could not get the manifest of package {0}".format(
+			", ".join("'{0}'".format(label) for label in unknown)
+		))
+
+	plan = {}
+	for manifest in manifests:
+		label = _package_label(manifest)
+		guid = guids[label]
+
+		if guid is None:
+			action = "create"
+		elif (__utils__['rapyutaio.manifest_digest'](existing[guid]) ==
+		      __utils__['rapyutaio.manifest_digest'](manifest)):
+			action = "unchanged"
+		else:
+			action = "replace"
+
+		plan[label] = {
+			"action": action,
+			"guid": guid,
+		}
+
+	return plan
+
+
+
+def upload_packages(manifests,
+                    replace=None,
+                    project_id=None,
+                    auth_token=None):
+	"""
+	Upload several package manifests concurrently.
+
+	replace
+		Dict of "<name> <version>" to the guid of the package each manifest
+		replaces. A package is only deleted if no deployment uses it.
+
+	Returns a dict of the packages ``created``, those ``replaced``, and any
+	that ``failed``
+	"""
+	replace = replace or {}
+
+	ret = {
+		"created": [],
+		"replaced": [],
+		"failed": {},
+	}
+
+	in_use = set(
+		guid
+		for guid
+		in replace.values()
+		if get_package_deployments(guid,
+		                           project_id=project_id,
+		                           auth_token=auth_token)
+	)
+
+	def upload(manifest):
+		label = _package_label(manifest)
+		guid = replace.get(label)
+
+		try:
+			__utils__['rapyutaio.deadline_check']("uploading package '{0}'".format(label))
+		except CommandExecutionError as e:
+			return str(e)
+
+		if guid in in_use:
+			return "Package is in use and can't be updated"
+
+		if guid is not None and not delete_package(guid=guid,
+		                                           project_id=project_id,
+		                                           auth_token=auth_token):
+			return "Could not delete the existing package"
+
+		if create_package(manifest=manifest,
+		                  project_id=project_id,
+		                  auth_token=auth_token) is False:
+			return "Could not be created"
+
+		return None
+
+	with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS) as executor:
+		for manifest, error in zip(manifests, executor.map(__utils__['rapyutaio.propagate_context'](upload), manifests)):
+			label = _package_label(manifest)
+			if error is not None:
+				ret['failed'][label] = error
+			elif label in replace:
+				ret['replaced'].append(label)
+			else:
+				ret['created'].append(label)
+
+	return ret
+
+
+
 # -----------------------------------------------------------------------------
 #
 # Networks
 #
 # -----------------------------------------------------------------------------
+def _list_networks(project_id=None,
+                   auth_token=None):
+	"""
+	Get the cached listing of all routed networks, in every phase
+	"""
+	url = CATALOG_HOST + "/routednetwork"
+	return __utils__['rapyutaio.api_request'](url=url,
+	                                          http_method="GET",
+	                                          project_id=project_id,
+	                                          auth_token=auth_token,
+	                                          cache="networks")
+
+
+
 def get_networks(project_id=None,
                  auth_token=None):
 	"""
 	Get a list of all routed networks
 	"""
-	url = CATALOG_HOST + "/routednetwork"
 	try:
-		response_body = __utils__['rapyutaio.api_request'](url=url,
-		                                                   http_method="GET",
-		                                                   project_id=project_id,
-		                                                   auth_token=auth_token)
+		response_body = _list_networks(project_id=project_id,
+		                               auth_token=auth_token)
 	except CommandExecutionError as e:
 		log.exception(e)
 		return None
@@ -345,7 +793,7 @@ def get_networks(project_id=None,
 		network
 		for network
 		in response_body
-		if network['internalDeploymentStatus']['phase'] in list(map(str, POSITIVE_PHASES))
+		if network['internalDeploymentStatus']['phase'] in POSITIVE_PHASE_NAMES
 	]
 
 	return networks
@@ -358,6 +806,9 @@ def get_network(name=None,
                 auth_token=None):
 	"""
 	Get an active Routed Network
+
+	Returns False if there is no such network. Raises CommandExecutionError
+	if the network could not be looked up.
 	"""
 	if guid is None:
 		if name is None:
@@ -365,14 +816,12 @@ def get_network(name=None,
 				"get_network needs either a valid guid or name"
 			)
 
-		networks = get_networks(project_id=project_id,
-		                        auth_token=auth_token)
+		network = _resolve_networks([name],
+		                            project_id=project_id,
+		                            auth_token=auth_token).get(name)
 
-		for network in networks:
-			if network['name'] == name:
-				if network['internalDeploymentStatus']['phase'] in ['In Progress', 'Succeeded', 'Provisioning']:
-					guid = network['guid']
-					break
+		if network is not None:
+			guid = network['guid']
 
 	if guid is None:
 		# We have no guid and the name didn't
@@ -386,8 +835,9 @@ def get_network(name=None,
 		                                          project_id=project_id,
 		                                          auth_token=auth_token)
 	except CommandExecutionError as e:
-		log.exception(e)
-		return None
+		if (e.info or {}).get('status') == 404:
+			return False
+		raise
 
 
 
@@ -412,7 +862,8 @@ def create_network(name,
 		                                          http_method="POST",
 		                                          data=data,
 		                                          project_id=project_id,
-		                                          auth_token=auth_token)
+		                                          auth_token=auth_token,
+		                                          invalidate="networks")
 	except CommandExecutionError as e:
 		log.exception(e)
 		return None
@@ -426,13 +877,12 @@ def delete_network(name=None,
 	"""
 	"""
 	if name is not None:
-		networks = get_networks(project_id=project_id,
-		                        auth_token=auth_token)
+		network = _resolve_networks([name],
+		                            project_id=project_id,
+		                            auth_token=auth_token).get(name)
 
-		for network in networks:
-			if network['name'] == name:
-				guid = network['guid']
-				break
+		if network is not None:
+			guid = network['guid']
 
 	if guid is None:
 		raise CommandExecutionError(
@@ -444,7 +894,8 @@ def delete_network(name=None,
 		__utils__['rapyutaio.api_request'](url=url,
 		                                   http_method="DELETE",
 		                                   project_id=project_id,
-		                                   auth_token=auth_token)
+		                                   auth_token=auth_token,
+		                                   invalidate="networks")
 	except CommandExecutionError as e:
 		log.exception(e)
 		return False
@@ -459,7 +910,7 @@ def delete_network(name=None,
 #
 # -----------------------------------------------------------------------------
 def get_deployments(package_uid=None,
-                    phase=list([str(pp) for pp in POSITIVE_PHASES]),
+                    phase=sorted(POSITIVE_PHASE_NAMES),
                     project_id=None,
                     auth_token=None,):
 	"""
@@ -474,26 +925,57 @@ def get_deployments(package_uid=None,
 		return __utils__['rapyutaio.api_request'](url=url,
 		                                          http_method="GET",
 		                                          project_id=project_id,
-		                                          auth_token=auth_token)
+		                                          auth_token=auth_token,
+		                                          cache="deployments")
 	except CommandExecutionError as e:
 		log.exception(e)
 		return None
 
 
 
+def get_package_deployments(guid,
+                            project_id=None,
+                            auth_token=None):
+	"""
+	List the active deployments of a package.
+
+	Answered from the cached deployment listing, indexed by package once per
+	listing, so checking many packages costs a single listing.
+	"""
+	deployments = get_deployments(project_id=project_id,
+	                              auth_token=auth_token)
+
+	if deployments is None:
+		raise CommandExecutionError("Could not list deployments")
+
+	def build(deployments):
+		index = {}
+		for deployment in deployments:
+			index.setdefault(deployment['packageId'], []).append(deployment)
+		return index
+
+	index = __utils__['rapyutaio.listing_index']("deployments_by_package", deployments, build)
+	return list(index.get(guid, []))
+
+
+
 def get_deployment(name=None,
                    id=None,
                    project_id=None,
                    auth_token=None):
 	"""
+	Get an active deployment by name or ID
+
+	Returns None if there is no such deployment. Raises
+	CommandExecutionError if the deployment could not be looked up.
 	"""
 	if name is not None:
-		deployments = get_deployments(project_id=project_id,
-		                              auth_token=auth_token)
+		deployment = _resolve_deployments([name],
+		                                  project_id=project_id,
+		                                  auth_token=auth_token).get(name)
 
-		for deployment in deployments:
-			if deployment['name'] == name:
-				id = deployment['deploymentId']
+		if deployment is not None:
+			id = deployment['deploymentId']
 
 	if id is None:
 		return None
@@ -505,8 +987,9 @@ def get_deployment(name=None,
 		                                          project_id=project_id,
 		                                          auth_token=auth_token)
 	except CommandExecutionError as e:
-		log.exception(e)
-		return None
+		if (e.info or {}).get('status') == 404:
+			return None
+		raise
 
 
 
@@ -515,11 +998,19 @@ def create_deployment(name,
                       package_name=None,
                       package_version=None,
                       networks=None,
-                      parameters={},
-                      dependencies=[],
+                      parameters=None,
+                      dependencies=None,
                       project_id=None,
-                      auth_token=None):
+                      auth_token=None,
+                      deadline=None):
 	"""
+	Provision a deployment of a package and wait until it has started
+
+	deadline
+		Seconds the whole operation, including waiting for the deployment,
+		may take. Once it has passed the operation fails, listing the steps
+		it completed. Waiting for the deployment to start is bounded by
+		``rapyutaio:provision_timeout`` either way.
 	"""
 	if package_uid is None:
 		if package_name is None or package_version is None:
@@ -527,21 +1018,55 @@ def create_deployment(name,
 				"create_deployment requires package_uid, or package_name and package_version"
 			)
 
+	with __utils__['rapyutaio.deadline'](deadline):
+		return _create_deployment(name,
+		                          package_uid=package_uid,
+		                          package_name=package_name,
+		                          package_version=package_version,
+		                          networks=networks,
+		                          parameters=parameters or {},
+		                          dependencies=dependencies or [],
+		                          project_id=project_id,
+		                          auth_token=auth_token)
+
+
+
+def _create_deployment(name,
+                       package_uid,
+                       package_name,
+                       package_version,
+                       networks,
+                       parameters,
+                       dependencies,
+                       project_id,
+                       auth_token):
+	"""
+	The steps of create_deployment(), checking the deadline between them
+	"""
+	done = []
+	check_deadline = __utils__['rapyutaio.deadline_check']
+
 	#
 	# Create provision configuration
 	#
-	package = get_package(name=package_name,
-	                      version=package_version,
-	                      guid=package_uid,
-	                      project_id=project_id,
-	                      auth_token=auth_token)
+	if package_uid is None:
+		package_uid = _find_package_guid(package_name,
+		                                 package_version,
+		                                 project_id=project_id,
+		                                 auth_token=auth_token)
 
-	if package:
-		plan = package['packageInfo']['plans'][0]
-	else:
-		raise CommandExecutionError(
-			"Could not find package '{0}'".format(package_name)
-		)
+		if package_uid is None:
+			check_deadline("finding package '{0}'".format(package_name), done)
+			raise CommandExecutionError(
+				"Could not find package '{0}'".format(package_name)
+			)
+		done.append("found package {0}".format(package_uid))
+
+	check_deadline("compiling the provisioning plan", done)
+	plan = _compile_plan(package_uid,
+	                     project_id=project_id,
+	                     auth_token=auth_token)
+	done.append("compiled plan {0}".format(plan['plan_id']))
 
 	provision_configuration = {
 		"accepts_incomplete": True,
@@ -554,69 +1079,92 @@ def create_deployment(name,
 		"parameters": {
 			"global": {},
 		},
-		"plan_id": plan['planId'],
-		"service_id": package['packageInfo']['guid'],
+		"plan_id": plan['plan_id'],
+		"service_id": package_uid,
 		"space_guid": "spaceGuid",
 		'instance_id': 'instanceId',
 		'organization_guid': 'organizationGuid',
 	}
 
-	for component in plan['components']['components']:
-		for internal_component in plan['internalComponents']:
-			if internal_component['componentName'] == component['name']:
-				component_id = internal_component['componentId']
-				break
+	for component in plan['components']:
+		component_overrides = parameters.get(component['name'], {})
 
 		component_parameters = {
-			"component_id": component_id,
-			# "bridge_params": {
-			# 	"alias": component['name']
-			# }
+			"component_id": component['id'],
 		}
-		for pkg_parameter in component['parameters']:
-			# component_parameters[pkg_parameter['name']] = pkg_parameter.get('default', None)
-			component_parameters[pkg_parameter['name']] = parameters.get(component['name'], {}).get(pkg_parameter['name'], pkg_parameter.get('default', None))
+		for param_name, default in component['defaults'].items():
+			component_parameters[param_name] = component_overrides.get(param_name, default)
 
-		provision_configuration['parameters'][component_id] = component_parameters
+		provision_configuration['parameters'][component['id']] = component_parameters
 
 	#
 	# Add routed networks
 	#
 	if networks is not None:
-		all_routed_networks = get_networks(project_id=project_id,
-		                                   auth_token=auth_token)
+		check_deadline("resolving routed networks", done)
 		network_names = networks.split(",")
-		network_guids = []
-		for network in all_routed_networks:
-			if network['name'] in network_names:
-				network_guids.append({
-					"guid": network['guid']
-				})
-
-		provision_configuration['context']['routedNetworks'] = network_guids
+		routed_networks = _resolve_networks(network_names,
+		                                    project_id=project_id,
+		                                    auth_token=auth_token)
+		done.append("resolved routed networks")
+
+		for network_name in network_names:
+			if network_name not in routed_networks:
+				log.warning("Routed network '{0}' not found".format(network_name))
+
+		provision_configuration['context']['routedNetworks'] = [
+			{
+				"guid": network['guid']
+			}
+			for network
+			in routed_networks.values()
+		]
 
 	#
 	# Dependencies
 	#
-	for dep_name in dependencies:
-		dep_dpl = __salt__['rapyutaio.get_deployment'](name=dep_name)
+	if dependencies:
+		# The listing already holds each deployment's ID, so a single
+		# listing resolves every dependency
+		check_deadline("resolving dependencies", done)
+		dependent_deployments = _resolve_deployments(dependencies,
+		                                             project_id=project_id,
+		                                             auth_token=auth_token)
+		done.append("resolved dependencies")
+
+		missing_dependencies = [
+			dep_name
+			for dep_name
+			in dependencies
+			if dep_name not in dependent_deployments
+		]
+		if missing_dependencies:
+			raise CommandExecutionError(
+				"Could not find dependent deployments: {0}".format(", ".join(missing_dependencies))
+			)
 
-		if dep_dpl is not None:
-			provision_configuration['context']['dependentDeployments'].append({
-				"dependentDeploymentId": dep_dpl['deploymentId']
-			})
+		provision_configuration['context']['dependentDeployments'] = [
+			{
+				"dependentDeploymentId": dependent_deployments[dep_name]['deploymentId']
+			}
+			for dep_name
+			in dependencies
+		]
 
 	#
 	# Provision
 	#
+	check_deadline("provisioning", done)
 	url = PROVISION_API_PATH + "/instanceId"
 	try:
 		response_body = __utils__['rapyutaio.api_request'](url=url,
 		                                                   http_method="PUT",
 		                                                   data=provision_configuration,
 		                                                   project_id=project_id,
-		                                                   auth_token=auth_token)
+		                                                   auth_token=auth_token,
+		                                                   invalidate="deployments")
 	except CommandExecutionError as e:
+		check_deadline("provisioning", done)
 		log.exception(e)
 		return False
 
@@ -624,12 +1172,30 @@ def create_deployment(name,
 	# Wait for the deployment to complete
 	#
 	deployment_id = response_body['operation']
-	deployment_phase = str(Phase.INPROGRESS)
-	while deployment_phase in list(map(str, [Phase.INPROGRESS, Phase.PROVISIONING])):
-		sleep(10)
+	done.append("requested deployment {0}".format(deployment_id))
 
-		deployment = get_deployment(id=deployment_id)
-		deployment_phase = deployment['phase']
+	deployment_phase = str(Phase.INPROGRESS)
+	provision_timeout = __salt__['config.get']("rapyutaio:provision_timeout", PROVISION_TIMEOUT)
+	with __utils__['rapyutaio.deadline'](provision_timeout):
+		while deployment_phase in list(map(str, [Phase.INPROGRESS, Phase.PROVISIONING])):
+			check_deadline("waiting for deployment {0} to start".format(deployment_id), done)
+			remaining = __utils__['rapyutaio.deadline_remaining']()
+			sleep(max(0, min(10, remaining)))
+
+			try:
+				deployment = get_deployment(id=deployment_id,
+				                            project_id=project_id,
+				                            auth_token=auth_token)
+			except CommandExecutionError:
+				check_deadline("waiting for deployment {0} to start".format(deployment_id), done)
+				raise
+
+			if deployment is None:
+				check_deadline("waiting for deployment {0} to start".format(deployment_id), done)
+				raise CommandExecutionError(
+					"Could not get the phase of deployment {0}".format(deployment_id)
+				)
+			deployment_phase = deployment['phase']
 
 	if deployment_phase == str(Phase.SUCCEEDED):
 		return deployment
@@ -649,10 +1215,15 @@ def delete_deployment(name=None,
 
 		{"async":false,"component_status":null}
 	"""
-	deployment = get_deployment(name=name,
-	                            id=id,
-	                            project_id=None,
-	                            auth_token=None)
+	try:
+		deployment = get_deployment(name=name,
+		                            id=id,
+		                            project_id=project_id,
+		                            auth_token=auth_token)
+	except CommandExecutionError as e:
+		# Not knowing whether it exists isn't the same as it being absent
+		log.exception(e)
+		return False
 
 	if deployment is None:
 		log.info(f"Deployment {name} does not exist")
@@ -668,7 +1239,8 @@ def delete_deployment(name=None,
 		                                   http_method="DELETE",
 		                                   params=params,
 		                                   project_id=project_id,
-		                                   auth_token=auth_token)
+		                                   auth_token=auth_token,
+		                                   invalidate="deployments")
 		return True
 	except CommandExecutionError as e:
 		log.exception(e)
@@ -693,12 +1265,219 @@ def get_dependencies(deployment_id,
 
 
 
+def _dependency_ids(dependencies):
+	"""
+	Return the set of deployment IDs in a get_dependencies() response
+	"""
+	if isinstance(dependencies, dict):
+		dependencies = dependencies.get('dependentDeployments') or []
+
+	dependency_ids = set()
+	for dependency in dependencies or []:
+		if isinstance(dependency, dict):
+			dependency_ids.add(dependency.get('dependentDeploymentId') or dependency.get('deploymentId'))
+		else:
+			dependency_ids.add(dependency)
+
+	return dependency_ids
+
+
+
+def _teardown_layers(dependencies):
+	"""
+	Order deployments for removal given a dict of deployment ID to the set
+	of IDs it depends on. Returns a list of sets of IDs; each set only
+	holds deployments nothing left depends on, so it can be removed
+	concurrently once the sets before it are gone.
+	"""
+	remaining = set(dependencies)
+	layers = []
+
+	while remaining:
+		depended_on = set()
+		for deployment_id in remaining:
+			depended_on |= dependencies[deployment_id]
+
+		layer = remaining - depended_on
+		if not layer:
+			raise CommandExecutionError(
+				"Circular dependency between deployments: {0}".format(", ".join(sorted(remaining)))
+			)
+
+		layers.append(layer)
+		remaining -= layer
+
+	return layers
+
+
+
+def _wait_deprovisioned(deployment_ids, deadline, project_id=None, auth_token=None):
+	"""
+	Poll the deployment listing until none of the IDs are active, backing
+	off between polls. Returns the IDs still active at the deadline.
+	"""
+	interval, max_interval = DEPROVISION_POLL_INTERVAL
+	remaining = set(deployment_ids)
+
+	while remaining:
+		# The listing is cached, make sure each poll sees the current state
+		__utils__['rapyutaio.cache_invalidate']("deployments")
+		deployments = get_deployments(project_id=project_id,
+		                              auth_token=auth_token)
+
+		if deployments is not None:
+			remaining &= {
+				deployment['deploymentId']
+				for deployment
+				in deployments
+			}
+
+		if not remaining or monotonic() + interval > deadline:
+			break
+
+		sleep(interval)
+		interval = min(interval * 2, max_interval)
+
+	return remaining
+
+
+
+def delete_deployments(names,
+                       timeout=DEPROVISION_TIMEOUT,
+                       project_id=None,
+                       auth_token=None):
+	"""
+	Remove several deployments, dependents before their dependencies.
+
+	Deployments that don't depend on each other are removed concurrently,
+	and each group is waited on until deprovisioned before the deployments
+	it depended on are removed.
+
+	names
+		List of deployment names
+
+	timeout
+		Seconds to wait for the whole teardown
+
+	Returns a dict of the deployments ``removed``, those already
+	``absent``, and any that ``failed``. Nothing is removed if the
+	dependencies of any of the deployments can't be looked up.
+
+	CLI Example::
+
+		salt myproxy rapyutaio.delete_deployments '[frontend, backend, database]'
+	"""
+	deadline = monotonic() + timeout
+
+	# An enclosing deadline may be sooner
+	remaining = __utils__['rapyutaio.deadline_remaining']()
+	if remaining is not None:
+		deadline = min(deadline, monotonic() + remaining)
+
+	deployments = {
+		deployment['deploymentId']: deployment
+		for deployment
+		in _resolve_deployments(names,
+		                        project_id=project_id,
+		                        auth_token=auth_token).values()
+	}
+	found_names = set(deployment['name'] for deployment in deployments.values())
+
+	ret = {
+		"removed": [],
+		"absent": [name for name in names if name not in found_names],
+		"failed": {},
+	}
+
+	with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS) as executor:
+		# Only dependencies within the set being removed affect the order
+		dependencies = dict(zip(
+			deployments,
+			executor.map(__utils__['rapyutaio.propagate_context'](
+			                 lambda deployment_id: get_dependencies(deployment_id,
+			                                                        project_id=project_id,
+			                                                        auth_token=auth_token)),
+			             deployments)
+		))
+
+		# A deployment whose dependencies are unknown may depend on any of
+		# the others, so none of them can safely be removed
+		unknown = sorted(deployments[deployment_id]['name']
+		                 for deployment_id, deployment_dependencies
+		                 in dependencies.items()
+		                 if deployment_dependencies is None)
+		if unknown:
+			for deployment in deployments.values():
+				if deployment['name'] in unknown:
+					ret['failed'][deployment['name']] = "Could not look up its dependencies"
+				else:
+					ret['failed'][deployment['name']] = (
+						"Not removed because the dependencies of {0} "
+						"could not be looked up".format(", ".join(unknown))
+					)
+			return ret
+
+		dependencies = {
+			deployment_id: _dependency_ids(deployment_dependencies) & set(deployments)
+			for deployment_id, deployment_dependencies
+			in dependencies.items()
+		}
+
+		for layer in _teardown_layers(dependencies):
+			deleted = dict(zip(
+				layer,
+				executor.map(__utils__['rapyutaio.propagate_context'](
+				                 lambda deployment_id: delete_deployment(id=deployment_id,
+				                                                         project_id=project_id,
+				                                                         auth_token=auth_token)),
+				             layer)
+			))
+
+			for deployment_id, result in deleted.items():
+				if not result:
+					ret['failed'][deployments[deployment_id]['name']] = "Could not be deleted"
+
+			pending = _wait_deprovisioned([deployment_id for deployment_id, result in deleted.items() if result],
+			                              deadline,
+			                              project_id=project_id,
+			                              auth_token=auth_token)
+
+			for deployment_id, result in deleted.items():
+				if result and deployment_id not in pending:
+					ret['removed'].append(deployments[deployment_id]['name'])
+
+			if pending:
+				for deployment_id in pending:
+					ret['failed'][deployments[deployment_id]['name']] = "Timed out waiting for deprovisioning"
+				break
+
+			if ret['failed']:
+				# Don't remove what the failed deployments still depend on
+				break
+
+	for deployment in deployments.values():
+		if deployment['name'] not in ret['removed'] and deployment['name'] not in ret['failed']:
+			ret['failed'][deployment['name']] = "Not removed because a deployment depending on it failed"
+
+	return ret
+
+
+
 def get_manifest(guid,
                  project_id=None,
                  auth_token=None):
 	"""
 	Get a manifest for a package like you would through the web interface
+
+	A package can't be changed without giving it a new guid, so manifests
+	are cached by guid.
 	"""
+	cache_key = "package:" + guid
+	manifest = __utils__['rapyutaio.manifest_cache_get'](cache_key)
+
+	if manifest is not None:
+		return manifest
+
 	package = get_package(guid=guid,
 	                      project_id=project_id,
 	                      auth_token=auth_token)
@@ -710,17 +1489,29 @@ def get_manifest(guid,
 	header_dict = {
 		"accept": "application/json"
 	}
-	response = __utils__['http.query'](url=url,
-	                                   header_dict=header_dict,
-	                                   http_method="GET",
-	                                   status=True)
+	manifest = __utils__['rapyutaio.fetch_url'](url, header_dict=header_dict)
+	__utils__['rapyutaio.manifest_cache_set'](cache_key, manifest)
+
+	return manifest
+
 
-	if 'error' in response:
-		raise CommandExecutionError(
-			response['error']
-		)
 
-	return __utils__['json.loads'](response['body'])
+def get_manifests(guids,
+                  project_id=None,
+                  auth_token=None):
+	"""
+	Get the manifests of several packages concurrently, as a dict keyed by
+	guid
+	"""
+	with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS) as executor:
+		return dict(zip(
+			guids,
+			executor.map(__utils__['rapyutaio.propagate_context'](
+			                 lambda guid: get_manifest(guid,
+			                                           project_id=project_id,
+			                                           auth_token=auth_token)),
+			             guids)
+		))
 
 
 
@@ -739,7 +1530,8 @@ def get_devices(tgt=None,
 		response_body = __utils__['rapyutaio.api_request'](url=url,
 		                                                   http_method="GET",
 		                                                   project_id=project_id,
-		                                                   auth_token=auth_token)
+		                                                   auth_token=auth_token,
+		                                                   cache="devices")
 	except CommandExecutionError as e:
 		log.exception(e)
 		return None
@@ -758,6 +1550,53 @@ def get_devices(tgt=None,
 
 
 
+def device_inventory(tgt=None,
+                     project_id=None,
+                     auth_token=None):
+	"""
+	A compact view of the devices, keyed by device name, for publishing to
+	the Salt mine so the master can target devices without calling the API
+
+	Each device is reduced to its uuid, status, labels and config variables,
+	with the labels and config variables as plain key/value dicts.
+
+	Publish it on its own schedule from the proxy's configuration:
+
+	.. code-block:: yaml
+
+		mine_functions:
+		  rapyutaio.device_inventory: []
+
+		schedule:
+		  rapyutaio_device_inventory:
+		    function: mine.send
+		    args:
+		      - rapyutaio.device_inventory
+		    minutes: 5
+
+	and read it on the master:
+
+	.. code-block:: jinja
+
+		{% set devices = salt['mine.get']('myproxy', 'rapyutaio.device_inventory')['myproxy'] %}
+	"""
+	devices = get_devices(tgt=tgt,
+	                      project_id=project_id,
+	                      auth_token=auth_token)
+
+	if devices is None:
+		return None
+
+	inventory = {}
+	for device in devices:
+		facts = __utils__['rapyutaio.device_facts'](device)
+		del facts['name']
+		inventory[device['name']] = facts
+
+	return inventory
+
+
+
 def get_device(name=None,
                device_id=None,
                project_id=None,
@@ -801,7 +1640,7 @@ def get_device(name=None,
 def cmd(tgt,
         cmd,
         shell=None,
-        env={},
+        env=None,
         bg=False,
         runas=None,
         cwd=None,
@@ -1004,56 +1843,42 @@ def get_topics(name=None,
 #
 # -----------------------------------------------------------------------------
 def _label_add(device_id, name, value, project_id, auth_token):
-	url = DEVICE_LABEL_API_PATH + str(device_id)
-	data = {
-		name: value,
+	return {
+		"url": DEVICE_LABEL_API_PATH + str(device_id),
+		"http_method": "POST",
+		"data": {
+			name: value,
+		},
+		"project_id": project_id,
+		"auth_token": auth_token,
+		"invalidate": "devices",
 	}
-	try:
-		response_body = __utils__['rapyutaio.api_request'](url=url,
-		                                                   http_method="POST",
-		                                                   data=data,
-		                                                   project_id=project_id,
-		                                                   auth_token=auth_token)
-	except CommandExecutionError as e:
-		log.exception(e)
-		return False
-
-	return response_body['response']['data']
 
 
 
 def _label_update(label_id, name, value, project_id, auth_token):
-	url = DEVICE_LABEL_API_PATH + str(label_id)
-	data = {
-		"key": name,
-		"value": value,
+	return {
+		"url": DEVICE_LABEL_API_PATH + str(label_id),
+		"http_method": "PUT",
+		"data": {
+			"key": name,
+			"value": value,
+		},
+		"project_id": project_id,
+		"auth_token": auth_token,
+		"invalidate": "devices",
 	}
-	try:
-		response_body = __utils__['rapyutaio.api_request'](url=url,
-		                                                   http_method="PUT",
-		                                                   data=data,
-		                                                   project_id=project_id,
-		                                                   auth_token=auth_token)
-	except CommandExecutionError as e:
-		log.exception(e)
-		return False
-
-	return response_body['response']['data']
 
 
 
 def _label_delete(label_id, project_id, auth_token):
-	url = DEVICE_LABEL_API_PATH + str(label_id)
-	try:
-		response_body = __utils__['rapyutaio.api_request'](url=url,
-		                                                   http_method="DELETE",
-		                                                   project_id=project_id,
-		                                                   auth_token=auth_token)
-	except CommandExecutionError as e:
-		log.exception(e)
-		return False
-
-	return response_body['response']['data']
+	return {
+		"url": DEVICE_LABEL_API_PATH + str(label_id),
+		"http_method": "DELETE",
+		"project_id": project_id,
+		"auth_token": auth_token,
+		"invalidate": "devices",
+	}
 
 
 
@@ -1064,6 +1889,8 @@ def label(tgt,
           auth_token=None):
 	"""
 	Set a label on one or more devices
+
+	The label requests for all the devices are sent concurrently.
 	"""
 	devices = get_devices(tgt, project_id=project_id, auth_token=auth_token)
 
@@ -1072,6 +1899,7 @@ def label(tgt,
 		"deleted": [],
 		"updated": [],
 	}
+	requests = []
 	for device in devices:
 		device_labels = {l['key']: l for l in device['labels']}
 		log.debug(device_labels)
@@ -1081,17 +1909,22 @@ def label(tgt,
 		except KeyError:
 			if value != "":
 				# add label
-				_label_add(device['uuid'], name, value, project_id, auth_token)
-				changes['added'].append(device['name'])
+				requests.append(("added", device, _label_add(device['uuid'], name, value, project_id, auth_token)))
 		else:
 			if value == "":
 				# delete label
-				_label_delete(label['id'], project_id, auth_token)
-				changes['deleted'].append(device['name'])
+				requests.append(("deleted", device, _label_delete(label['id'], project_id, auth_token)))
 			elif value != device_labels[name]['value']:
 				# update label
-				_label_update(label['id'], name, value, project_id, auth_token)
-				changes['updated'].append(device['name'])
+				requests.append(("updated", device, _label_update(label['id'], name, value, project_id, auth_token)))
+
+	responses = __utils__['rapyutaio.api_request_many']([request for _, _, request in requests])
+
+	for (change, device, _), response in zip(requests, responses):
+		if isinstance(response, CommandExecutionError):
+			log.error(response)
+		else:
+			changes[change].append(device['name'])
 
 	return {
 		"label": name,
@@ -1101,6 +1934,79 @@ def label(tgt,
 
 
 
+def snapshot(path,
+             project_id=None,
+             auth_token=None):
+	"""
+	Export the project's catalog, manifests, networks, deployments and
+	devices to a snapshot file.
+
+	With ``rapyutaio:snapshot`` set to the file's path, every read is
+	answered from the snapshot instead of rapyuta.io, and every write is
+	refused, so states can be planned with ``test=True`` and no network.
+
+	CLI Example:
+
+	.. code-block:: bash
+
+		salt myproxy rapyutaio.snapshot /srv/ci/project.snapshot.json
+		salt-call --local state.apply test=True pillar='{"rapyutaio": {"snapshot": "/srv/ci/project.snapshot.json"}}'
+	"""
+	def fetch_all(fetch, ids):
+		with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS) as executor:
+			return list(executor.map(__utils__['rapyutaio.propagate_context'](fetch), ids))
+
+	with __utils__['rapyutaio.snapshot_record']() as responses:
+		packages = get_packages(project_id=project_id,
+		                        auth_token=auth_token)
+		if packages is None:
+			raise CommandExecutionError("Could not list packages")
+
+		guids = [package['id'] for package in packages]
+		fetch_all(lambda guid: get_package(guid=guid,
+		                                   project_id=project_id,
+		                                   auth_token=auth_token),
+		          guids)
+		get_manifests(guids,
+		              project_id=project_id,
+		              auth_token=auth_token)
+
+		networks = _list_networks(project_id=project_id,
+		                          auth_token=auth_token)
+		fetch_all(lambda network: get_network(guid=network['guid'],
+		                                      project_id=project_id,
+		                                      auth_token=auth_token),
+		          networks)
+
+		deployments = get_deployments(project_id=project_id,
+		                              auth_token=auth_token)
+		if deployments is None:
+			raise CommandExecutionError("Could not list deployments")
+
+		fetch_all(lambda deployment: get_deployment(id=deployment['deploymentId'],
+		                                            project_id=project_id,
+		                                            auth_token=auth_token),
+		          deployments)
+		fetch_all(lambda deployment: get_dependencies(deployment['deploymentId'],
+		                                              project_id=project_id,
+		                                              auth_token=auth_token),
+		          deployments)
+
+		get_devices(project_id=project_id,
+		            auth_token=auth_token)
+
+	__utils__['rapyutaio.snapshot_write'](path, responses, project_id=project_id)
+
+	return {
+		"path": path,
+		"packages": len(packages),
+		"networks": len(networks),
+		"deployments": len(deployments),
+		"responses": len(responses),
+	}
+
+
+
 def test(project_id=None, auth_token=None):
 	"""
 	Just for testing
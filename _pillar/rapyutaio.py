@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+Provide each device minion with its Rapyuta IO labels and config variables
+
+Minions are matched to devices by name. The device listing is fetched
+once for the whole fleet and reused for ``ttl`` seconds, so refreshing
+the pillar of every minion costs one API call rather than one per minion.
+When a new listing arrives only the devices that changed get new pillar
+data.
+
+Configure the credentials in the master config under ``rapyutaio`` as for
+the proxy minion, then:
+
+.. code-block:: yaml
+
+	ext_pillar:
+	  - rapyutaio:
+	      key: rapyutaio
+	      ttl: 60
+
+This gives a device minion pillar data like:
+
+.. code-block:: yaml
+
+	rapyutaio:
+	  device:
+	    name: robot1
+	    uuid: 2b4c8e6e-...
+	    status: ONLINE
+	    labels:
+	      site: tokyo
+	    config_variables:
+	      ros_distro: melodic
+"""
+import copy
+import logging
+import time
+from salt.exceptions import CommandExecutionError
+
+
+
+log = logging.getLogger(__name__)
+
+
+
+__virtualname__ = "rapyutaio"
+
+CORE_API_HOST = "https://gaapiserver.apps.rapyuta.io"
+DEVICE_API_BASE_PATH = CORE_API_HOST + "/api/device-manager/v0/"
+DEVICE_API_PATH = DEVICE_API_BASE_PATH + "devices/"
+
+# Default seconds the device listing is reused between pillar compilations
+DEFAULT_TTL = 60
+
+# When the device listing was last fetched, and the pillar data of each
+# device as (device, pillar data) by name
+FLEET = {
+	"fetched_at": 0,
+	"devices": {},
+}
+
+
+
+def __virtual__():
+	return __virtualname__
+
+
+
+def _fleet_pillar(listing):
+	"""
+	Pillar data for every device in a listing, reusing that of the devices
+	which haven't changed
+	"""
+	previous = FLEET['devices']
+	devices = {}
+	for device in listing:
+		old = previous.get(device['name'])
+		if old is not None and old[0] == device:
+			devices[device['name']] = old
+		else:
+			devices[device['name']] = (device, __utils__['rapyutaio.device_facts'](device))
+	return devices
+
+
+
+def _refresh(ttl, project_id):
+	"""
+	Fetch the device listing if the last one is older than ``ttl`` and
+	update the pillar data of the devices that changed
+	"""
+	if time.time() - FLEET['fetched_at'] < ttl:
+		return
+
+	response_body = __utils__['rapyutaio.api_request'](url=DEVICE_API_PATH,
+	                                                   http_method="GET",
+	                                                   project_id=project_id,
+	                                                   cache="devices")
+	FLEET['fetched_at'] = time.time()
+
+	# Only rebuilt when the cached listing has changed
+	FLEET['devices'] = __utils__['rapyutaio.listing_index']("pillar",
+	                                                        response_body['response']['data'],
+	                                                        _fleet_pillar)
+
+
+
+def ext_pillar(minion_id,
+               pillar,
+               key="rapyutaio",
+               ttl=DEFAULT_TTL,
+               project_id=None):
+	"""
+	Return the Rapyuta IO device data for the minion whose ID is the name
+	of a device
+	"""
+	try:
+		_refresh(ttl, project_id)
+	except CommandExecutionError as e:
+		# Serve the last listing we have rather than no pillar at all
+		log.error("Could not fetch the Rapyuta IO device listing: {0}".format(e))
+
+	device = FLEET['devices'].get(minion_id)
+	if device is None:
+		return {}
+
+	# Copied because the pillar compiler merges into what it is given
+	return {
+		key: {
+			"device": copy.deepcopy(device[1]),
+		}
+	}
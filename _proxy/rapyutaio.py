@@ -10,6 +10,7 @@ Run a standalone proxy-minion as a non-root user:
 	             --pid-file=/srv/proxy/myproxy.pid \
 	             --log-level=debug
 """
+import concurrent.futures
 import logging
 from salt.exceptions import CommandExecutionError
 
@@ -35,6 +36,15 @@ USER_API_PATH = CORE_API_HOST + "/api/user/me/get"
 
 SYSTEM_CONFIG_PATHS = ("/lib/systemd/system", "/usr/lib/systemd/system")
 
+# Resources init() loads concurrently so the first job doesn't have to.
+# Override with the ``rapyutaio:warmup`` config list. init() only reports
+# the proxy ready once the ``rapyutaio:warmup_critical`` ones are loaded.
+WARMUP = ("grains", "catalog", "networks", "deployments", "devices")
+WARMUP_CRITICAL = ("grains",)
+
+# Seconds init() waits for the critical resources
+WARMUP_TIMEOUT = 60
+
 
 
 # Variables are scoped to this module so we can have persistent data
@@ -58,13 +68,93 @@ def __virtual__():
 
 
 
+def _warmup_functions():
+	"""
+	Map each warm-up resource to the function that loads (and caches) it
+	"""
+	return {
+		"grains": grains,
+		"catalog": lambda: __salt__['rapyutaio.get_packages'](),
+		"networks": lambda: __salt__['rapyutaio.get_networks'](),
+		"deployments": lambda: __salt__['rapyutaio.get_deployments'](),
+		"devices": lambda: __salt__['rapyutaio.get_devices'](),
+	}
+
+
+
+def _warmup_failed(resource, future):
+	"""
+	Log why a warm-up resource could not be loaded, return True if it failed
+	"""
+	if future.exception() is not None:
+		log.error("rapyutaio proxy could not load {0}: {1}".format(resource, future.exception()))
+		return True
+
+	if future.result() is None:
+		# The execution functions return None when the request failed
+		log.error("rapyutaio proxy could not load {0}".format(resource))
+		return True
+
+	return False
+
+
+
 def init(opts):
 	"""
-	Every proxy module needs an 'init', though you can
-	just put DETAILS['initialized'] = True here if nothing
-	else needs to be done.
+	Log in to rapyuta.io and load the configured resources concurrently,
+	so the first job after a restart finds them cached.
+
+	The proxy is only reported as initialized once the critical resources
+	are loaded. The others finish loading in the background.
 	"""
 	log.debug("rapyutaio proxy init() called...")
+
+	resources = __salt__['config.get']("rapyutaio:warmup", WARMUP)
+	critical = __salt__['config.get']("rapyutaio:warmup_critical", WARMUP_CRITICAL)
+	functions = _warmup_functions()
+
+	for resource in resources:
+		if resource not in functions:
+			log.warning("Unknown rapyutaio warm-up resource: {0}".format(resource))
+
+	# Log in first so the concurrent requests share one token
+	try:
+		__utils__['rapyutaio.login']()
+	except CommandExecutionError as e:
+		log.error("rapyutaio proxy could not log in: {0}".format(e))
+		return False
+
+	executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(len(resources), 1),
+	                                                 thread_name_prefix="rapyutaio-warmup")
+	futures = {
+		resource: executor.submit(functions[resource])
+		for resource
+		in resources
+		if resource in functions
+	}
+	executor.shutdown(wait=False)
+
+	for resource, future in futures.items():
+		if resource not in critical:
+			future.add_done_callback(lambda f, resource=resource: _warmup_failed(resource, f))
+
+	critical_futures = {
+		resource: future
+		for resource, future
+		in futures.items()
+		if resource in critical
+	}
+	done, pending = concurrent.futures.wait(critical_futures.values(), timeout=WARMUP_TIMEOUT)
+
+	if pending:
+		log.error("rapyutaio proxy timed out loading {0}".format(
+			", ".join(r for r, f in critical_futures.items() if f in pending)
+		))
+		return False
+
+	if any([_warmup_failed(resource, future) for resource, future in critical_futures.items()]):
+		return False
+
 	DETAILS["initialized"] = True
 	return True
 
@@ -99,10 +189,12 @@ def grains():
 	log.debug("rapyutaio proxy grains() called...")
 	global GRAINS_CACHE
 	if not GRAINS_CACHE:
-		user_grains = __utils__['rapyutaio.api_request'](USER_API_PATH)
+		user_grains = __utils__['rapyutaio.api_request'](USER_API_PATH,
+		                                                 cache="account")
 
 		org_id = user_grains['organization']['guid']
-		org_grains = __utils__['rapyutaio.api_request'](ORG_API_PATH.format(org_id=org_id))
+		org_grains = __utils__['rapyutaio.api_request'](ORG_API_PATH.format(org_id=org_id),
+		                                                cache="account")
 
 		GRAINS_CACHE = {
 			"user": user_grains,
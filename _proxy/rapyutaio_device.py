@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+A proxy-minion for a single device in a Rapyuta IO project, meant to be
+run many times over inside one deltaproxy control process.
+
+Every device proxy in the process shares the rapyutaio utils client: one
+auth token, and one cached device listing indexed by name. Each proxy
+itself only keeps the name of its device.
+
+Enable deltaproxy in the control proxy's config file:
+
+.. code-block:: yaml
+
+	metaproxy: deltaproxy
+
+configure its pillar with the IDs of the devices:
+
+.. code-block:: yaml
+
+	proxy:
+	  proxytype: deltaproxy
+	  ids:
+	    - robot1
+	    - robot2
+
+and the pillar of each device minion with the proxy and the ``rapyutaio``
+credentials, which every sub-proxy reads from its own pillar:
+
+.. code-block:: yaml
+
+	proxy:
+	  proxytype: rapyutaio_device
+	  # defaults to the minion ID
+	  device: robot1
+
+	rapyutaio:
+	  project_id: "project-xxxxxxxxxxxxxxxxxxxxxxxx"
+	  username: "user.name@email.com"
+	  password: "xxxxxxxxxxxxxxxx"
+"""
+import logging
+from salt.exceptions import CommandExecutionError
+
+
+
+# This must be present or the Salt loader won't load this module
+__proxyenabled__ = ["rapyutaio_device"]
+
+
+
+# Scoped to this sub-proxy's copy of the module: just the device name
+DETAILS = {}
+
+log = logging.getLogger(__file__)
+
+
+
+def __virtual__():
+	"""
+	Only return if all the modules are available
+	"""
+	log.debug("rapyutaio_device proxy __virtual__() called...")
+	return True
+
+
+
+def init(opts):
+	"""
+	Record which device this proxy represents. Nothing is fetched here;
+	the shared device listing is loaded by the first proxy that needs it.
+	"""
+	log.debug("rapyutaio_device proxy init() called...")
+	DETAILS["device"] = opts["proxy"].get("device", opts["id"])
+	DETAILS["initialized"] = True
+	return True
+
+
+
+def initialized():
+	"""
+	Since grains are loaded in many different places and some of those
+	places occur before the proxy can be initialized, return whether
+	our init() function has been called
+	"""
+	return DETAILS.get("initialized", False)
+
+
+
+def _device():
+	"""
+	The device's summary from the shared device listing, or None
+	"""
+	return __utils__['rapyutaio.find_device'](DETAILS["device"])
+
+
+
+def alive(opts):
+	"""
+	The device proxy is alive while Rapyuta IO can be reached
+	"""
+	try:
+		return _device() is not None
+	except CommandExecutionError:
+		return False
+
+
+
+def ping():
+	"""
+	Is the device online?
+	"""
+	try:
+		device = _device()
+	except CommandExecutionError:
+		return False
+
+	return device is not None and device['status'] == "ONLINE"
+
+
+
+def grains():
+	"""
+	The device's details, labels and config variables
+	"""
+	device = _device()
+
+	if device is None:
+		return {}
+
+	return {
+		"rapyutaio": {
+			"device": __utils__['rapyutaio.device_facts'](device),
+		}
+	}
+
+
+
+def grains_refresh():
+	"""
+	Refresh the grains from the shared device listing
+	"""
+	return grains()
+
+
+
+def shutdown(opts):
+	"""
+	For this proxy shutdown is a no-op
+	"""
+	log.debug("rapyutaio_device proxy shutdown() called...")
+
+
+
+def get_reboot_active():
+	return False
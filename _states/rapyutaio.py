@@ -34,8 +34,11 @@ config:
 """
 
 from __future__ import absolute_import, print_function, unicode_literals
+import fnmatch
+import glob
 import logging
-from salt.exceptions import CommandExecutionError
+import os
+from salt.exceptions import CommandExecutionError, SaltInvocationError
 
 
 
@@ -54,11 +57,46 @@ def __virtual__():
 
 
 
+def _with_deadline(name, deadline, state, *args, **kwargs):
+	"""
+	Run a state with every request it makes bounded by ``deadline``
+	seconds, failing it with the steps done so far once that has passed
+	"""
+	with __utils__['rapyutaio.deadline'](deadline):
+		try:
+			return state(name, *args, **kwargs)
+		except CommandExecutionError as e:
+			comment = str(e)
+			if (e.info or {}).get('status') != 408:
+				# A request cut short by the deadline may fail some other way
+				remaining = __utils__['rapyutaio.deadline_remaining']()
+				if remaining is None or remaining > 0:
+					raise
+				comment = "Deadline exceeded: {0}".format(e)
+			return {
+				"name": name,
+				"result": False,
+				"changes": {},
+				"comment": comment,
+			}
+
+
+
 # -----------------------------------------------------------------------------
 #
 # Packages
 #
 # -----------------------------------------------------------------------------
+def _offline(ret):
+	"""
+	Fail a state that would change the project while a snapshot is served
+	"""
+	ret['result'] = False
+	ret['comment'] = "rapyutaio is offline, serving a snapshot: changes can only be planned with test=True"
+	return ret
+
+
+
 def package_present(name,
                     source=None,
                     template=None,
@@ -66,7 +104,8 @@ def package_present(name,
                     context=None,
                     contents=None,
                     show_changes=True,
-                    saltenv="base"):
+                    saltenv="base",
+                    deadline=None):
 	"""
 	Ensure that a package exists in the project catalog with matching definition.
 
@@ -125,7 +164,31 @@ def package_present(name,
 	show_changes
 		Output a unified diff of the old manifest and new manifest. If ``False``
 		return a boolean if any changes were made.
+
+	deadline
+		Seconds every request made by the state may take in total
 	"""
+	return _with_deadline(name,
+	                      deadline,
+	                      _package_present,
+	                      source=source,
+	                      template=template,
+	                      defaults=defaults,
+	                      context=context,
+	                      contents=contents,
+	                      show_changes=show_changes,
+	                      saltenv=saltenv)
+
+
+
+def _package_present(name,
+                     source,
+                     template,
+                     defaults,
+                     context,
+                     contents,
+                     show_changes,
+                     saltenv):
 	ret = {
 		"name": name,
 		"result": False,
@@ -139,25 +202,18 @@ def package_present(name,
 	# Get the content of the new manifest
 	#
 	if source is not None:
-		source_contents = __salt__['cp.get_file_str'](source, saltenv=saltenv)
-
-		if source_contents is False:
+		try:
+			new_manifest = __salt__['rapyutaio.load_manifest'](source,
+			                                                   template=template,
+			                                                   defaults=defaults,
+			                                                   context=context,
+			                                                   saltenv=saltenv)
+		except CommandExecutionError:
 			ret['comment'] = "Source file not found: {}".format(source)
 			return ret
-
-		if template is not None:
-			source_contents = __salt__["file.apply_template_on_contents"](
-				source_contents, template, context, defaults, saltenv
-			)
-
-		try:
-			new_manifest = __utils__['yaml.load'](source_contents)
-		except Exception:
-			try:
-				new_manifest = __utils__['json.loads'](source_contents)
-			except Exception:
-				ret['comment'] = "Manifest source must be a JSON or YAML file"
-				return ret
+		except SaltInvocationError as e:
+			ret['comment'] = str(e)
+			return ret
 
 	if contents is not None:
 		new_manifest = __utils__['rapyutaio.deep_merge'](new_manifest, contents)
@@ -182,20 +238,28 @@ def package_present(name,
 		old_package = __salt__['rapyutaio.get_package'](name=man_name,
 		                                                version=man_version)
 	except CommandExecutionError as e:
-		ret['comment'] = e
+		ret['comment'] = str(e)
 		return ret
 
 	if old_package:
 		old_package_uid = old_package['packageInfo']['guid']
 		old_manifest = __salt__['rapyutaio.get_manifest'](guid=old_package_uid)
+
+		if old_manifest is None:
+			__utils__['rapyutaio.deadline_check']("fetching the manifest of package '{} {}'".format(man_name, man_version))
+			ret['comment'] = "Could not get the manifest of package '{} {}'".format(man_name, man_version)
+			return ret
 	else:
-		old_manifest = {}
+		old_manifest = None
 
 	if old_manifest:
 		# Is the new manifest different to the old
 		ret['changes'] = __utils__['data.recursive_diff'](old_manifest, new_manifest)
 
 		if not ret['changes']:
+			# The lookups may have been cut short rather than answered
+			__utils__['rapyutaio.deadline_check']("checking package '{} {}'".format(man_name, man_version))
+
 			# The manifest is already in the correct state so return immediately
 			ret['result'] = True
 			ret['comment'] = "Package '{} {}' is in the correct state".format(man_name, man_version)
@@ -215,7 +279,7 @@ def package_present(name,
 			ret['comment'] = "New package '{} {}' would be created".format(man_name, man_version)
 			ret['changes'] = {
 				'new': new_manifest,
-				'old': old_manifest
+				'old': old_manifest or {}
 			}
 
 		if not show_changes:
@@ -223,6 +287,9 @@ def package_present(name,
 
 		return ret
 
+	if __utils__['rapyutaio.offline']():
+		return _offline(ret)
+
 	# TODO: Create a "clean" manifest from the remote/existing manifest that only contains keys
 	# that we know are required or will be used and compare only those
 
@@ -231,27 +298,44 @@ def package_present(name,
 	#
 	if old_manifest is not None:
 		if not ret['changes']:
+			__utils__['rapyutaio.deadline_check']("checking package '{} {}'".format(man_name, man_version))
 			ret['comment'] = "Package '{} {}' is in the correct state".format(man_name, man_version)
 			ret['result'] = True
 			return ret
 
 		# First check that the package is not in use
-		pkg_deployments = __salt__['rapyutaio.get_deployments'](package_uid=old_package_uid)
-		if pkg_deployments != []:
+		try:
+			pkg_deployments = __salt__['rapyutaio.get_package_deployments'](old_package_uid)
+		except CommandExecutionError as e:
+			ret['comment'] = str(e)
+			return ret
+
+		if pkg_deployments:
 			ret['comment'] = "Package '{} {}' is in use and can't be updated.".format(man_name, man_version)
 			return ret
 
+		__utils__['rapyutaio.deadline_check']("replacing package '{} {}'".format(man_name, man_version))
+
 		try:
-			__salt__['rapyutaio.delete_package'](guid=old_package_uid)
+			deleted = __salt__['rapyutaio.delete_package'](guid=old_package_uid)
 		except CommandExecutionError as e:
-			ret['comment'] = e
+			ret['comment'] = str(e)
+			return ret
+
+		if not deleted:
+			ret['comment'] = "Package '{} {}' could not be deleted".format(man_name, man_version)
 			return ret
 
 	#
 	# Attempt to upload the new manifest
 	#
+	__utils__['rapyutaio.deadline_check']("uploading package '{} {}'".format(man_name, man_version))
 	response = __salt__['rapyutaio.create_package'](manifest=new_manifest)
 
+	if response is False:
+		ret['comment'] = "Package '{} {}' could not be uploaded".format(man_name, man_version)
+		return ret
+
 	ret['result'] = True
 
 	if old_manifest is not None:
@@ -286,7 +370,7 @@ def package_absent(name, version):
 	try:
 		package = __salt__['rapyutaio.get_package'](name=name, version=version)
 	except CommandExecutionError as e:
-		ret['comment'] = e
+		ret['comment'] = str(e)
 		return ret
 
 	if not package:
@@ -303,10 +387,17 @@ def package_absent(name, version):
 		ret['comment'] = "Package '{0} {1}' would be deleted".format(name, version)
 		return ret
 
+	if __utils__['rapyutaio.offline']():
+		return _offline(ret)
+
 	try:
-		__salt__['rapyutaio.delete_package'](name=name, version=version)
+		deleted = __salt__['rapyutaio.delete_package'](name=name, version=version)
 	except CommandExecutionError as e:
-		ret['comment'] = e
+		ret['comment'] = str(e)
+		return ret
+
+	if not deleted:
+		ret['comment'] = "Package '{0} {1}' could not be deleted".format(name, version)
 		return ret
 
 	ret['result'] = True
@@ -318,6 +409,203 @@ def package_absent(name, version):
 
 
 
+def _manifest_sources(source, saltenv):
+	"""
+	Expand a directory or glob of manifest sources into the list of files
+	"""
+	if not any(char in source for char in "*?["):
+		source = source.rstrip("/") + "/*"
+
+	if not source.startswith("salt://"):
+		return sorted(path for path in glob.glob(source) if os.path.isfile(path))
+
+	pattern = source[len("salt://"):]
+	prefix = pattern
+	for char in "*?[":
+		prefix = prefix.split(char)[0]
+	prefix = prefix[:prefix.rfind("/") + 1]
+
+	return sorted(
+		"salt://" + path
+		for path
+		in __salt__['cp.list_master'](saltenv=saltenv, prefix=prefix)
+		if fnmatch.fnmatch(path, pattern) and path.count("/") == pattern.count("/")
+	)
+
+
+
+def packages_present(name,
+                     source=None,
+                     template=None,
+                     defaults=None,
+                     context=None,
+                     saltenv="base",
+                     deadline=None):
+	"""
+	Ensure every package manifest in a directory is in the project catalog.
+
+	The catalog is read once for all the manifests, each manifest is
+	compared with the catalog's by content hash, and the packages that need
+	creating or replacing are uploaded concurrently.
+
+	name
+		Name of the state, also used as the source if ``source`` is not given
+
+	source
+		A directory of manifests, or a glob matching them, on the Salt Master
+		(``salt://``) or the minion
+
+	template, defaults, context
+		Render every manifest through a template engine, as in
+		``package_present``
+
+	deadline
+		Seconds every request made by the state may take in total. Packages
+		not uploaded by then are reported as failed.
+
+	.. code-block:: yaml
+
+		Ensure the catalog is up to date:
+		  rapyutaio.packages_present:
+		    - source: salt://packages/*.yaml
+	"""
+	return _with_deadline(name,
+	                      deadline,
+	                      _packages_present,
+	                      source=source,
+	                      template=template,
+	                      defaults=defaults,
+	                      context=context,
+	                      saltenv=saltenv)
+
+
+
+def _packages_present(name,
+                      source,
+                      template,
+                      defaults,
+                      context,
+                      saltenv):
+	ret = {
+		"name": name,
+		"result": False,
+		"comment": "",
+		"changes": {},
+	}
+
+	if source is None:
+		source = name
+
+	sources = _manifest_sources(source, saltenv)
+
+	if not sources:
+		ret['comment'] = "No manifests found in {}".format(source)
+		return ret
+
+	#
+	# Load every manifest
+	#
+	manifests = {}
+	manifest_sources = {}
+	errors = []
+	for manifest_source in sources:
+		try:
+			manifest = __salt__['rapyutaio.load_manifest'](manifest_source,
+			                                               template=template,
+			                                               defaults=defaults,
+			                                               context=context,
+			                                               saltenv=saltenv)
+		except (CommandExecutionError, SaltInvocationError) as e:
+			errors.append("{0}: {1}".format(manifest_source, e))
+			continue
+
+		if 'name' not in manifest or 'packageVersion' not in manifest:
+			errors.append("{0}: Manifest must have a name and packageVersion".format(manifest_source))
+			continue
+
+		label = "{0} {1}".format(manifest['name'], manifest['packageVersion'])
+		if label in manifests:
+			errors.append("{0}: Package '{1}' is already defined in {2}".format(manifest_source,
+			                                                                    label,
+			                                                                    manifest_sources[label]))
+			continue
+
+		manifests[label] = manifest
+		manifest_sources[label] = manifest_source
+
+	if errors:
+		ret['comment'] = "\n".join(errors)
+		return ret
+
+	#
+	# Compare them with one snapshot of the catalog
+	#
+	try:
+		plan = __salt__['rapyutaio.plan_packages'](list(manifests.values()))
+	except CommandExecutionError as e:
+		ret['comment'] = str(e)
+		return ret
+
+	create = sorted(label for label, step in plan.items() if step['action'] == "create")
+	replace = {
+		label: step['guid']
+		for label, step
+		in plan.items()
+		if step['action'] == "replace"
+	}
+
+	if not create and not replace:
+		__utils__['rapyutaio.deadline_check']("checking {0} packages".format(len(plan)))
+		ret['result'] = True
+		ret['comment'] = "All {0} packages are in the correct state".format(len(plan))
+		return ret
+
+	#
+	# Test
+	#
+	if __opts__['test']:
+		ret['result'] = None
+		ret['comment'] = "{0} packages would be created and {1} updated".format(len(create), len(replace))
+		ret['changes'] = {
+			"created": create,
+			"replaced": sorted(replace),
+		}
+		return ret
+
+	if __utils__['rapyutaio.offline']():
+		return _offline(ret)
+
+	try:
+		upload = __salt__['rapyutaio.upload_packages'](
+			[manifests[label] for label in create + sorted(replace)],
+			replace=replace
+		)
+	except CommandExecutionError as e:
+		ret['comment'] = str(e)
+		return ret
+
+	for change in ("created", "replaced"):
+		if upload[change]:
+			ret['changes'][change] = sorted(upload[change])
+
+	if upload['failed']:
+		ret['comment'] = "\n".join(
+			"Package '{0}': {1}".format(label, reason)
+			for label, reason
+			in sorted(upload['failed'].items())
+		)
+		return ret
+
+	ret['result'] = True
+	ret['comment'] = "{0} packages created, {1} updated and {2} unchanged".format(
+		len(upload['created']),
+		len(upload['replaced']),
+		len(plan) - len(create) - len(replace)
+	)
+	return ret
+
+
+
 # -----------------------------------------------------------------------------
 #
 # Networks
@@ -378,7 +666,11 @@ def network_present(name,
 		"changes": {},
 	}
 
-	old_network = __salt__['rapyutaio.get_network'](name=name)
+	try:
+		old_network = __salt__['rapyutaio.get_network'](name=name)
+	except CommandExecutionError as e:
+		ret['comment'] = str(e)
+		return ret
 
 	new_network = {
 		"name": name,
@@ -429,6 +721,9 @@ def network_present(name,
 		ret['changes']['new'] = new_network
 		return ret
 
+	if __utils__['rapyutaio.offline']():
+		return _offline(ret)
+
 	response = __salt__['rapyutaio.create_network'](name=name,
 	                                                runtime=runtime,
 	                                                ros_distro=ros_distro,
@@ -451,7 +746,11 @@ def network_absent(name):
 		"changes": {},
 	}
 
-	old_network = __salt__['rapyutaio.get_network'](name=name)
+	try:
+		old_network = __salt__['rapyutaio.get_network'](name=name)
+	except CommandExecutionError as e:
+		ret['comment'] = str(e)
+		return ret
 
 	if not old_network:
 		ret['result'] = True
@@ -474,7 +773,13 @@ def network_absent(name):
 		ret['comment'] = "Network {0} would be deleted".format(name)
 		return ret
 
-	__salt__['rapyutaio.delete_network'](guid=old_network_guid)
+	if __utils__['rapyutaio.offline']():
+		return _offline(ret)
+
+	if not __salt__['rapyutaio.delete_network'](guid=old_network_guid):
+		ret['changes'] = {}
+		ret['comment'] = "Network {0} could not be deleted".format(name)
+		return ret
 
 	ret['result'] = True
 	ret['comment'] = "Network {0} deleted".format(name)
@@ -510,8 +815,31 @@ def volume_absent():
 def deployment_present(name,
                        package_name,
                        package_version,
-                       parameters={},
-                       dependencies=[]):
+                       parameters=None,
+                       dependencies=None,
+                       deadline=None):
+	"""
+	Ensure a deployment of a package exists.
+
+	deadline
+		Seconds every request made by the state, including waiting for a new
+		deployment to start, may take in total
+	"""
+	return _with_deadline(name,
+	                      deadline,
+	                      _deployment_present,
+	                      package_name=package_name,
+	                      package_version=package_version,
+	                      parameters=parameters,
+	                      dependencies=dependencies)
+
+
+
+def _deployment_present(name,
+                        package_name,
+                        package_version,
+                        parameters,
+                        dependencies):
 	ret = {
 		"name": name,
 		"result": False,
@@ -520,15 +848,17 @@ def deployment_present(name,
 	}
 
 	log.info(f"deployment_present: {name}")
-	existing_deployment = __salt__['rapyutaio.get_deployment'](name=name)
+	try:
+		existing_deployment = __salt__['rapyutaio.get_deployment'](name=name)
+	except CommandExecutionError as e:
+		ret['comment'] = str(e)
+		return ret
 
 	log.info(f"existing_deployment: {existing_deployment}")
 	if existing_deployment is not None:
 		pkg_id = existing_deployment['packageId']
-		existing_dpl_pkg = __salt__['rapyutaio.get_package'](name=package_name,
-		                                                     version=package_version)
-		log.fatal(existing_dpl_pkg)
-		if pkg_id == existing_dpl_pkg['packageInfo']['guid']:
+		if pkg_id == __salt__['rapyutaio.get_package_guid'](package_name, package_version):
+			__utils__['rapyutaio.deadline_check']("checking deployment '{0}'".format(name))
 			ret['result'] = True
 			ret['comment'] = "Deployment {} of package {}:{} already exists".format(name, package_name, package_version)
 			return ret
@@ -554,6 +884,9 @@ def deployment_present(name,
 
 		return ret
 
+	if __utils__['rapyutaio.offline']():
+		return _offline(ret)
+
 	try:
 		__salt__['rapyutaio.create_deployment'](name=name,
 		                                        package_name=package_name,
@@ -580,7 +913,11 @@ def deployment_absent(name):
 		"changes": {},
 	}
 
-	existing_deployment = __salt__['rapyutaio.get_deployment'](name=name)
+	try:
+		existing_deployment = __salt__['rapyutaio.get_deployment'](name=name)
+	except CommandExecutionError as e:
+		ret['comment'] = str(e)
+		return ret
 
 	if not existing_deployment:
 		ret['result'] = True
@@ -592,9 +929,104 @@ def deployment_absent(name):
 		ret['comment'] = "Deployment '{0}' would be removed".format(name)
 		return ret
 
-	__salt__['rapyutaio.delete_deployment'](name=name)
+	if __utils__['rapyutaio.offline']():
+		return _offline(ret)
+
+	if not __salt__['rapyutaio.delete_deployment'](name=name):
+		ret['comment'] = "Deployment '{0}' could not be removed".format(name)
+		return ret
 
 	ret['result'] = True
 	ret['changes']['removed'] = name
 	ret['comment'] = "Deployment '{0}' removed".format(name)
 	return ret
+
+
+
+def deployments_absent(name,
+                       deployments=None,
+                       timeout=600):
+	"""
+	Ensure several deployments are removed, dependents before their
+	dependencies. Independent deployments are removed concurrently and
+	the state waits until they are deprovisioned.
+
+	name
+		Name of the state, also used as the deployment name if
+		``deployments`` is not given
+
+	deployments
+		List of deployment names to remove
+
+	timeout
+		Seconds to wait for the whole teardown
+
+	.. code-block:: yaml
+
+		Tear down the demo stack:
+		  rapyutaio.deployments_absent:
+		    - deployments:
+		      - frontend
+		      - backend
+		      - database
+		    - timeout: 900
+	"""
+	ret = {
+		"name": name,
+		"result": False,
+		"comment": "",
+		"changes": {},
+	}
+
+	if deployments is None:
+		deployments = [name]
+
+	if __opts__['test']:
+		listing = __salt__['rapyutaio.get_deployments']()
+
+		if listing is None:
+			ret['comment'] = "Could not list deployments"
+			return ret
+
+		existing = [
+			deployment['name']
+			for deployment
+			in listing
+			if deployment['name'] in deployments
+		]
+
+		if not existing:
+			ret['result'] = True
+			ret['comment'] = "Deployments are not present"
+			return ret
+
+		ret['result'] = None
+		ret['comment'] = "Deployments {0} would be removed".format(", ".join(sorted(set(existing))))
+		return ret
+
+	if __utils__['rapyutaio.offline']():
+		return _offline(ret)
+
+	try:
+		teardown = __salt__['rapyutaio.delete_deployments'](deployments, timeout=timeout)
+	except CommandExecutionError as e:
+		ret['comment'] = str(e)
+		return ret
+
+	if teardown['removed']:
+		ret['changes']['removed'] = teardown['removed']
+
+	if teardown['failed']:
+		ret['comment'] = "\n".join(
+			"Deployment '{0}': {1}".format(dpl_name, reason)
+			for dpl_name, reason
+			in teardown['failed'].items()
+		)
+		return ret
+
+	ret['result'] = True
+	if teardown['removed']:
+		ret['comment'] = "Deployments {0} removed".format(", ".join(teardown['removed']))
+	else:
+		ret['comment'] = "Deployments are not present"
+	return ret
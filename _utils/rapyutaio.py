@@ -1,22 +1,185 @@
 import salt.config
+import salt.loader
+import salt.utils.files
+import salt.utils.http
+import salt.utils.json
 import salt.utils.sdb
-from datetime import datetime
+import salt.utils.stringutils
+import asyncio
+import atexit
+import calendar
+import concurrent.futures
+import contextlib
+import contextvars
 import copy
+import gzip
+import hashlib
 import logging
+import json
+import os
+import socket
+import sqlite3
+import ssl
+import sys
+import threading
+import time
+import types
 from collections.abc import Mapping
-from salt.matchers.compound_match import match as salt_compound_match
+from urllib.parse import quote, urlencode, urlparse
 from salt.exceptions import CommandExecutionError, InvalidConfigError
 
+try:
+	import fcntl
+	HAS_FCNTL = True
+except ImportError:
+	HAS_FCNTL = False
 
+try:
+	import orjson
+	HAS_ORJSON = True
+except ImportError:
+	HAS_ORJSON = False
 
+try:
+	import ujson
+	HAS_UJSON = True
+except ImportError:
+	HAS_UJSON = False
+
+try:
+	import aiohttp
+	HAS_AIOHTTP = True
+except ImportError:
+	HAS_AIOHTTP = False
+
+
+
+# Only the execution modules this module needs, loaded on first use by
+# _config_get(). Loading every minion module here would duplicate the
+# whole loader in each proxy and job process.
 __salt__ = None
 
+# The matcher modules, loaded on first use by match()
+MATCHERS = None
+
+# Guards loading __salt__ and MATCHERS, which threads may need at once
+LOADER_LOCK = threading.Lock()
+
 
 
 log = logging.getLogger(__name__)
 
 
 
+# A deltaproxy gives each of its sub-proxies its own loader, and so its own
+# copy of this module. State that every proxy in the process should share
+# lives on a plain module registered in sys.modules instead.
+_SHARED = sys.modules.setdefault("rapyutaio_shared", types.ModuleType("rapyutaio_shared")).__dict__
+
+# Validators and parsed bodies of cached GET responses, keyed by
+# (resource, project_id, url, params). Persists for the life of the process
+# and is backed by an SQLite database in the minion cachedir shared by all
+# job processes.
+RESPONSE_CACHE = _SHARED.setdefault("RESPONSE_CACHE", {})
+
+# Held while parsing the raw body of a cache entry
+CACHE_ENTRY_LOCK = _SHARED.setdefault("CACHE_ENTRY_LOCK", threading.Lock())
+
+# The auth token last read or renewed by any proxy in the process, under
+# the "current" key, so it isn't read back from sdb on every request
+TOKEN = _SHARED.setdefault("TOKEN", {})
+
+# Indexes built by listing_index() from the last listing seen, as
+# (listing, index) by name. A cached listing that hasn't changed is the
+# same object, so its indexes are only built once.
+LISTING_INDEXES = _SHARED.setdefault("LISTING_INDEXES", {})
+
+# Parsed manifests, keyed by the hash of their source and template context
+MANIFESTS = _SHARED.setdefault("MANIFESTS", {})
+
+# Responses being recorded into a snapshot, under the "current" key
+SNAPSHOT_RECORDING = {}
+
+# Responses of the snapshots served in offline mode, by path
+SNAPSHOTS = {}
+
+# Interactions loaded from cassettes for replay, by path, as a dict of
+# request to the list of its recorded responses
+CASSETTES = {}
+
+# Serialises writes to the cassette being recorded
+CASSETTE_LOCK = threading.Lock()
+
+# Request headers never written to a cassette
+CASSETTE_REDACTED_HEADERS = frozenset(["authorization"])
+
+# The event loop running the aiohttp client in a daemon thread, and the
+# client's pooled session, keyed by the pid of the process that started
+# them. Shared by every proxy in the process.
+ASYNC_CLIENT = _SHARED.setdefault("ASYNC_CLIENT", {})
+ASYNC_CLIENT_LOCK = _SHARED.setdefault("ASYNC_CLIENT_LOCK", threading.Lock())
+
+# Monotonic time by which the current operation must finish, or None. A
+# context variable, so each thread and task has its own; thread pools need
+# propagate_context() to carry it into their workers.
+DEADLINE = _SHARED.setdefault("DEADLINE", contextvars.ContextVar("rapyutaio_deadline", default=None))
+
+# Connections the aiohttp client keeps open, and so requests in flight
+HTTP_CONNECTION_LIMIT = 100
+
+# Times a GET or HEAD request is retried after a connection error or a
+# gateway error, waiting HTTP_RETRY_BACKOFF seconds, doubled each time.
+# Other methods aren't, as rapyuta.io provisions deployments with PUT and
+# each one creates a new deployment.
+HTTP_RETRIES = 2
+HTTP_RETRY_BACKOFF = 0.5
+HTTP_RETRY_STATUSES = frozenset([502, 503, 504])
+
+# GET requests in flight in this process, keyed by project, token, URL and
+# params, as the Future each one's result is shared through
+IN_FLIGHT = _SHARED.setdefault("IN_FLIGHT", {})
+IN_FLIGHT_LOCK = _SHARED.setdefault("IN_FLIGHT_LOCK", threading.Lock())
+
+# Result shared with the callers waiting on a GET that ran out of its own
+# caller's time, telling them to send it again themselves
+IN_FLIGHT_RETRY = _SHARED.setdefault("IN_FLIGHT_RETRY", object())
+
+# Seconds a process waits for another one fetching the same listing before
+# fetching it itself
+FLIGHT_LOCK_TIMEOUT = 10
+
+# Default seconds a cached listing is used without asking rapyuta.io.
+# Override per resource with the ``rapyutaio:cache_ttl`` config dict.
+CACHE_TTL = {
+	"account": 3600,
+	"catalog": 300,
+	"networks": 60,
+	"deployments": 30,
+	"devices": 30,
+}
+
+# Seconds to wait for another process holding the cache database lock
+CACHE_LOCK_TIMEOUT = 10
+
+# Seconds before a token's expiryAt at which it is renewed. Override with
+# ``rapyutaio:token_refresh_margin``.
+TOKEN_REFRESH_MARGIN = 300
+
+# Seconds to wait for another process that is logging in
+LOGIN_LOCK_TIMEOUT = 30
+
+# True in the process running the rapyutaio engine, which serves the
+# listing mirror rather than reading from it
+SERVING_MIRROR = False
+
+# Listings serialised for the mirror, as {disk key: (digest, bytes)}
+MIRROR_BODIES = {}
+
+# Seconds to wait for the engine to answer a mirror request
+MIRROR_TIMEOUT = 1
+
+
+
 LOGIN_URL = 'https://garip.apps.rapyuta.io/user/login?type=high'
 
 CATALOG_HOST = "https://gacatalog.apps.rapyuta.io"
@@ -35,61 +198,138 @@ def __virtual__():
 	"""
 	Load as a different name
 	"""
-	global __salt__
-	if __salt__ is None:
-		__salt__ = salt.loader.minion_mods(__opts__)
 	return True
 
 TESTVAL = "Hello"
 
 
+
+def _config_get(key, default=None):
+	"""
+	Look up a configuration value with ``config.get``, loading just the
+	config execution module the first time it is needed
+	"""
+	global __salt__
+	if __salt__ is None:
+		with LOADER_LOCK:
+			if __salt__ is None:
+				__salt__ = salt.loader.minion_mods(__opts__, whitelist=['config'])
+	return __salt__['config.get'](key, default)
+
+
 def test():
 	return TESTVAL
 
 
 
+def json_dumps(obj):
+	"""
+	Serialise an API request body using the fastest available JSON
+	library (orjson, then ujson, then the standard library)
+	"""
+	if HAS_ORJSON:
+		return orjson.dumps(obj)
+	if HAS_UJSON:
+		return ujson.dumps(obj, ensure_ascii=False)
+	return json.dumps(obj, ensure_ascii=False)
+
+
+
+def json_loads(body):
+	"""
+	Parse an API response body (str or bytes) using the fastest available
+	JSON library (orjson, then ujson, then the standard library)
+	"""
+	if HAS_ORJSON:
+		return orjson.loads(body)
+	if HAS_UJSON:
+		return ujson.loads(body)
+	return json.loads(body)
+
+
+
 def get_config(project_id, auth_token):
 	"""
 	If there is no project_id or auth token provided, this
 	will attempt to fetch it from the Salt configuration
 	"""
-	if not project_id and __salt__['config.get']("rapyutaio:project_id"):
-		project_id = __salt__['config.get']("rapyutaio:project_id")
+	if not project_id and _config_get("rapyutaio:project_id"):
+		project_id = _config_get("rapyutaio:project_id")
 
-	if not auth_token and __salt__['config.get']("rapyutaio:auth_token"):
-		auth_token = __salt__['config.get']("rapyutaio:auth_token")
+	if not auth_token and _config_get("rapyutaio:auth_token"):
+		auth_token = _config_get("rapyutaio:auth_token")
 
 	return (project_id, auth_token)
 
 
 
 def get_credentials():
-	config = __salt__['config.get']('rapyutaio')
+	config = _config_get('rapyutaio')
 	return (config['username'], config['password'])
 
 
 
+def device_facts(device):
+	"""
+	The name, uuid, status, labels and config variables of a device from
+	the device listing, with the labels and config variables as plain
+	key/value dicts
+	"""
+	return {
+		"name": device['name'],
+		"uuid": device['uuid'],
+		"status": device['status'],
+		"labels": {
+			label['key']: label['value']
+			for label
+			in device['labels']
+		},
+		"config_variables": {
+			var['key']: var['value']
+			for var
+			in device['config_variables']
+		},
+	}
+
+
+
+def listing_index(name, listing, build):
+	"""
+	Return ``build(listing)``, reused for as long as ``listing`` is the same
+	object. Indexes are shared by every module and proxy in the process,
+	``name`` tells them apart.
+	"""
+	cached = LISTING_INDEXES.get(name)
+	if cached is not None and cached[0] is listing:
+		return cached[1]
+
+	index = build(listing)
+	LISTING_INDEXES[name] = (listing, index)
+	return index
+
+
+
 def match(tgt, device):
 	"""
 	Matches devices against a compound target string using the
-	device name as the id and device labels as the grains
+	device name as the id and its device_facts() as the grains
+
+	The device is matched against its own copy of the minion opts, so
+	devices can be matched from several threads at once.
 	"""
-	opts = __opts__
+	global MATCHERS
+	if MATCHERS is None:
+		with LOADER_LOCK:
+			if MATCHERS is None:
+				MATCHERS = salt.loader.matchers(__opts__)
 
+	opts = dict(__opts__)
 	opts.update({
 		"id": device['name'],
-		"grains": {
-			"labels": {
-				label['key']: label['value'] for label in device['labels']
-			},
-			"config_variables": {
-				var['key']: var['value'] for var in device['config_variables']
-			},
-			"status": device['status']
-		}
+		"grains": device_facts(device),
 	})
 
-	return salt_compound_match(tgt, opts)
+	return MATCHERS['compound_match.match'](tgt, opts=opts, minion_id=device['name'])
 
 
 
@@ -128,22 +368,185 @@ def get_auth_token(username, password):
 	response_body = salt.utils.json.loads(response['body'])
 	response_data = response_body['data']
 
+	# Record when the token was issued and when it should be renewed so
+	# every process can refresh it ahead of expiry instead of after a 401
+	now = time.time()
+	try:
+		# Trim off the nanoseconds when parsing the datetime
+		expires_at = calendar.timegm(time.strptime(response_data['expiryAt'][:19], '%Y-%m-%dT%H:%M:%S'))
+	except (KeyError, ValueError):
+		expires_at = now
+	margin = float(_config_get("rapyutaio:token_refresh_margin", TOKEN_REFRESH_MARGIN))
+	response_data['issuedAt'] = now
+	response_data['renewAt'] = max(now, expires_at - margin)
+	response_data['issuedBy'] = "{0}:{1}".format(__opts__.get('id'), os.getpid())
+
 	salt.utils.sdb.sdb_set("sdb://rapyutaio/auth_token", response_data, __opts__, None)
+	TOKEN['current'] = response_data
 
 	return response_data
 
 
 
-def _renew_token():
+def _cached_token():
+	"""
+	Return the token cached in ``sdb://rapyutaio/auth_token`` if it is not
+	yet due for renewal, otherwise None
+	"""
+	cached_token = TOKEN.get('current')
+
+	if cached_token is None or cached_token['renewAt'] <= time.time():
+		cached_token = salt.utils.sdb.sdb_get('sdb://rapyutaio/auth_token', __opts__, None)
+
+	if not cached_token:
+		return None
+
+	if 'renewAt' not in cached_token:
+		# Tokens cached before renewAt was recorded
+		try:
+			cached_token['renewAt'] = calendar.timegm(time.strptime(cached_token['expiryAt'][:19], '%Y-%m-%dT%H:%M:%S'))
+		except (KeyError, ValueError):
+			return None
+
+	if cached_token['renewAt'] <= time.time():
+		return None
+
+	TOKEN['current'] = cached_token
+	return cached_token
+
+
+
+@contextlib.contextmanager
+def _file_lock(name, timeout, waiting_for):
+	"""
+	Hold an exclusive file lock in the minion cachedir, shared by every
+	job process.
+
+	If the lock can't be taken within ``timeout`` seconds the caller goes
+	ahead without it rather than failing.
+	"""
+	if not HAS_FCNTL:
+		yield
+		return
+
+	lock_dir = os.path.join(__opts__['cachedir'], 'rapyutaio')
+	os.makedirs(lock_dir, exist_ok=True)
+
+	with salt.utils.files.fopen(os.path.join(lock_dir, name), 'a') as lock_file:
+		deadline = time.time() + timeout
+		locked = False
+
+		while not locked:
+			try:
+				fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+				locked = True
+			except OSError:
+				if time.time() >= deadline:
+					log.warning("Timed out waiting for %s" % waiting_for)
+					break
+				time.sleep(0.1)
+
+		try:
+			yield
+		finally:
+			if locked:
+				fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+
+def _login_lock():
+	"""
+	Lock out other processes while logging in, so only one process at a
+	time renews the token
+	"""
+	return _file_lock('login.lock',
+	                  LOGIN_LOCK_TIMEOUT,
+	                  "another process to log in to rapyuta.io")
+
+
+
+def _flight_lock(cache_key):
+	"""
+	Lock out other processes while fetching a listing, so that they wait
+	and then read it from the on-disk cache instead of fetching it too
+	"""
+	timeout = FLIGHT_LOCK_TIMEOUT
+	remaining = deadline_remaining()
+	if remaining is not None:
+		timeout = max(0, min(timeout, remaining))
+
+	digest = hashlib.sha1(salt.utils.stringutils.to_bytes(repr(cache_key))).hexdigest()
+	return _file_lock('flight-{0}.lock'.format(digest),
+	                  timeout,
+	                  "another process to fetch {0}".format(cache_key[2]))
+
+
+
+def _newer_token(rejected_token):
+	"""
+	Return the token cached in ``sdb://rapyutaio/auth_token`` if it was
+	issued after ``rejected_token`` and is not yet due for renewal,
+	otherwise None
+	"""
+	rejected = TOKEN.get('current') or {}
+	rejected_at = rejected.get('issuedAt', 0) if rejected.get('token') == rejected_token else 0
+
+	cached_token = salt.utils.sdb.sdb_get('sdb://rapyutaio/auth_token', __opts__, None)
+
+	if (not cached_token or
+	    cached_token.get('token') == rejected_token or
+	    cached_token.get('issuedAt', 0) <= rejected_at or
+	    cached_token.get('renewAt', 0) <= time.time()):
+		return None
+
+	TOKEN['current'] = cached_token
+	return cached_token
+
+
+
+def _renew_token(rejected_token=None):
 	"""
 	Login to rapyuta.io using credentials in the minion config
 
 	rapyutaio:
 	  username: "first.last@email.com"
 	  password: "mypassword"
+
+	Processes renewing at the same time queue on a file lock. Whoever
+	gets the lock after the first one reuses the token it cached instead
+	of logging in again, if it was issued after ``rejected_token``.
 	"""
-	username, password = get_credentials()
-	return get_auth_token(username, password)
+	with _login_lock():
+		if rejected_token is None:
+			cached_token = _cached_token()
+		else:
+			# The rejected token may still look fresh in memory, read what
+			# the other processes cached instead
+			cached_token = _newer_token(rejected_token)
+
+		if cached_token is not None:
+			return cached_token
+
+		username, password = get_credentials()
+		return get_auth_token(username, password)
+
+
+
+def login():
+	"""
+	Return a usable auth token, logging in to rapyuta.io only if the cached
+	token is missing or due for renewal
+	"""
+	if _config_get("rapyutaio:cassette_mode") == "replay":
+		# Recorded responses don't depend on the token
+		return "REDACTED"
+
+	cached_token = _cached_token()
+
+	if cached_token is None:
+		cached_token = _renew_token()
+
+	return cached_token['token']
 
 
 
@@ -159,27 +562,542 @@ def _header_dict(project_id, auth_token):
 
 
 
-def _send_request(url, header_dict={}, method="GET", data=None, params=None):
+@contextlib.contextmanager
+def deadline(seconds=None):
 	"""
-	Sends an HTTP request, parses the result, raises an exception on error
+	Bound every request made in the block to ``seconds`` from now, or to
+	the enclosing deadline if that is sooner. With ``seconds`` None the
+	enclosing deadline, if any, is left as it is.
+	"""
+	token = None
+	if seconds is not None:
+		at = time.monotonic() + float(seconds)
+		current = DEADLINE.get()
+		token = DEADLINE.set(at if current is None else min(at, current))
+
+	try:
+		yield
+	finally:
+		if token is not None:
+			DEADLINE.reset(token)
+
+
+
+def deadline_remaining():
+	"""
+	Seconds left before the current deadline, or None without one
+	"""
+	at = DEADLINE.get()
+	if at is None:
+		return None
+	return at - time.monotonic()
+
+
+
+def deadline_check(doing, done=()):
+	"""
+	Raise a CommandExecutionError if the current deadline has passed,
+	saying what was being done and listing the steps already done
+	"""
+	remaining = deadline_remaining()
+	if remaining is None or remaining > 0:
+		return
+
+	message = "Deadline exceeded while {0}".format(doing)
+	if done:
+		message += "; done: {0}".format(", ".join(done))
+
+	raise CommandExecutionError(
+		message=message,
+		info={
+			"status": 408,
+			"done": list(done),
+		}
+	)
+
+
+
+def propagate_context(fn):
+	"""
+	Wrap ``fn`` to run in a copy of the caller's context, so the current
+	deadline carries into thread pool workers
+	"""
+	context = contextvars.copy_context()
+
+	def run(*args, **kwargs):
+		return context.copy().run(fn, *args, **kwargs)
+
+	return run
+
+
+
+def _http_backend():
+	"""
+	The HTTP client requests are sent with: Salt's, unless
+	``rapyutaio:http_backend`` is ``aiohttp`` and aiohttp is installed
+	"""
+	if HAS_AIOHTTP and _config_get("rapyutaio:http_backend", "salt") == "aiohttp":
+		return "aiohttp"
+	return "salt"
+
+
+
+def _async_client():
+	"""
+	Return the event loop and session of the aiohttp client, starting them
+	in this process on first use
+	"""
+	with ASYNC_CLIENT_LOCK:
+		client = ASYNC_CLIENT.get(os.getpid())
+
+		if client is None:
+			# Anything inherited from a parent process died with the fork
+			ASYNC_CLIENT.clear()
+
+			loop = asyncio.new_event_loop()
+			threading.Thread(target=loop.run_forever,
+			                 name="rapyutaio-http",
+			                 daemon=True).start()
+			session = asyncio.run_coroutine_threadsafe(_async_session(), loop).result()
+			client = ASYNC_CLIENT[os.getpid()] = (loop, session)
+			atexit.register(_async_close)
+
+	return client
+
+
+
+async def _async_session():
+	"""
+	An aiohttp session set up from the same minion options as Salt's HTTP
+	client: ``verify_ssl``, ``ca_bundle`` and the request and connect
+	timeouts
+	"""
+	if __opts__.get('verify_ssl', True):
+		ssl_context = ssl.create_default_context(cafile=salt.utils.http.get_ca_bundle(__opts__))
+	else:
+		ssl_context = False
+	connector = aiohttp.TCPConnector(limit=HTTP_CONNECTION_LIMIT, ssl=ssl_context)
+	return aiohttp.ClientSession(connector=connector,
+	                             timeout=_async_timeout(__opts__.get('http_request_timeout', 3600)))
+
+
+
+def _async_timeout(total):
+	"""
+	An aiohttp timeout of ``total`` seconds, connecting within Salt's
+	``http_connect_timeout`` of them
+	"""
+	connect = __opts__.get('http_connect_timeout',
+	                       salt.config.DEFAULT_MINION_OPTS['http_connect_timeout'])
+	return aiohttp.ClientTimeout(total=total, connect=min(total, connect))
+
+
+
+def _async_proxy(url):
+	"""
+	The proxy URL an aiohttp request to ``url`` goes through, from Salt's
+	``proxy_host``, ``proxy_port``, ``proxy_username``, ``proxy_password``
+	and ``no_proxy`` options, or None
+	"""
+	proxy_host = __opts__.get('proxy_host')
+	proxy_port = __opts__.get('proxy_port')
+
+	if not (proxy_host and proxy_port):
+		return None
+	if urlparse(url).hostname in __opts__.get('no_proxy', []):
+		return None
+
+	proxy_username = __opts__.get('proxy_username')
+	proxy_password = __opts__.get('proxy_password')
+	if proxy_username and proxy_password:
+		return "http://{0}:{1}@{2}:{3}".format(quote(proxy_username, safe=""),
+		                                       quote(proxy_password, safe=""),
+		                                       proxy_host,
+		                                       proxy_port)
+	return "http://{0}:{1}".format(proxy_host, proxy_port)
+
+
+
+def _async_close():
+	"""
+	Close this process's aiohttp session, if it started one
+	"""
+	client = ASYNC_CLIENT.get(os.getpid())
+	if client is not None:
+		loop, session = client
+		try:
+			asyncio.run_coroutine_threadsafe(session.close(), loop).result(timeout=1)
+		except Exception:
+			pass
+
+
+
+def _async_run(coro):
+	"""
+	Run a coroutine on the aiohttp client's loop and wait for its result
+	"""
+	loop, _ = _async_client()
+	return asyncio.run_coroutine_threadsafe(coro, loop).result()
+
+
+
+async def _async_query(url, header_dict, method="GET", data=None, params=None, deadline_at=None):
+	"""
+	Send an HTTP request with the pooled aiohttp client and return a
+	response dict like salt.utils.http.query's. GET and HEAD requests are
+	retried after connection and gateway errors.
+
+	``deadline_at`` is the caller's deadline, as the loop doesn't share the
+	caller's context. Each attempt only gets the time left before it.
+	"""
+	_, session = ASYNC_CLIENT[os.getpid()]
+	body = json_dumps(data) if data is not None else None
+	retries = HTTP_RETRIES if method in ("GET", "HEAD") else 0
+
+	for attempt in range(retries + 1):
+		if attempt:
+			await asyncio.sleep(HTTP_RETRY_BACKOFF * 2 ** (attempt - 1))
+
+		timeout = None
+		if deadline_at is not None:
+			remaining = deadline_at - time.monotonic()
+			if remaining <= 0:
+				if not attempt:
+					response = {
+						"status": 408,
+						"headers": {},
+						"body": b"",
+						"error": "Deadline exceeded",
+					}
+				break
+			timeout = _async_timeout(remaining)
+
+		try:
+			async with session.request(method,
+			                           url,
+			                           headers=header_dict,
+			                           data=body,
+			                           params=params,
+			                           proxy=_async_proxy(url),
+			                           **({"timeout": timeout} if timeout else {})) as resp:
+				response = {
+					"status": resp.status,
+					# aiohttp's keys are istr, which orjson won't serialise
+					"headers": {str(key): value for key, value in resp.headers.items()},
+					"body": await resp.read(),
+				}
+		except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+			response = {
+				"status": 599,
+				"headers": {},
+				"body": b"",
+				"error": "{0}: {1}".format(type(e).__name__, e),
+			}
+			if deadline_at is not None and time.monotonic() >= deadline_at:
+				response['status'] = 408
+				response['error'] = "Deadline exceeded: " + response['error']
+				break
+			continue
+
+		if response['status'] >= 400:
+			response['error'] = "HTTP {0}: {1}".format(response['status'], resp.reason)
+
+		if response['status'] not in HTTP_RETRY_STATUSES:
+			break
+
+	return response
+
+
+
+async def _async_api_request(project_id,
+                             auth_token,
+                             deadline_at,
+                             url,
+                             http_method="GET",
+                             header_dict=None,
+                             data=None,
+                             params=None):
+	"""
+	An authenticated request to rapyuta.io, sent from the aiohttp client's
+	loop. The token is renewed and the request retried once on a 401,
+	unless ``auth_token`` was the caller's own.
+	"""
+	loop = asyncio.get_running_loop()
+	generated_auth_token = None
+
+	if auth_token is None:
+		# login() may wait on the login lock, so keep it off the loop
+		generated_auth_token = await loop.run_in_executor(None, login)
+
+	def headers(token):
+		headers = dict(header_dict or {})
+		headers.update(_header_dict(project_id, token))
+		headers['Accept-Encoding'] = "gzip"
+		if data is not None:
+			headers['Content-Type'] = "application/json"
+		return headers
+
+	response = await _async_query(url, headers(auth_token or generated_auth_token), http_method, data, params,
+	                              deadline_at=deadline_at)
+
+	if response['status'] == 401 and auth_token is None:
+		renewed = await loop.run_in_executor(None, _renew_token, generated_auth_token)
+		response = await _async_query(url, headers(renewed['token']), http_method, data, params,
+		                              deadline_at=deadline_at)
+
+	_raise_for_error(response)
+
+	if response['body']:
+		return json_loads(response['body'])
+	else:
+		return {}
+
+
+
+def api_request_many(requests, max_concurrency=HTTP_CONNECTION_LIMIT):
+	"""
+	Send many requests to rapyuta.io concurrently.
+
+	``requests`` is a list of dicts of api_request() arguments. Returns a
+	list of their response bodies in the same order, with the
+	CommandExecutionError in place of any request that failed. Each
+	resource named by an ``invalidate`` argument is invalidated once, after
+	all the requests.
+
+	With the aiohttp client, every request is sent from a single thread
+	over its pooled connections. Cached listing requests, or any request
+	when serving a snapshot or using a cassette, go through api_request().
+	"""
+	requests = [dict(request) for request in requests]
+	invalidate = set(request.pop('invalidate', None) for request in requests)
+	invalidate.discard(None)
+
+	@propagate_context
+	def sync_request(request):
+		try:
+			return api_request(**request)
+		except CommandExecutionError as e:
+			return e
+
+	if (_http_backend() != "aiohttp" or
+	    _config_get("rapyutaio:snapshot") or
+	    _config_get("rapyutaio:cassette")):
+		with concurrent.futures.ThreadPoolExecutor(max_workers=min(max_concurrency, 32)) as executor:
+			results = list(executor.map(sync_request, requests))
+	else:
+		default_project_id = _config_get("rapyutaio:project_id")
+		deadline_at = DEADLINE.get()
+
+		async def send_all():
+			loop = asyncio.get_running_loop()
+			semaphore = asyncio.Semaphore(max_concurrency)
+
+			async def send(request):
+				async with semaphore:
+					if request.get('cache'):
+						return await loop.run_in_executor(None, sync_request, request)
+					request.pop('cache', None)
+
+					project_id = request.pop('project_id', None) or default_project_id
+					if not project_id:
+						raise InvalidConfigError("No rapyutaio project_id found")
+
+					try:
+						return await _async_api_request(project_id,
+						                                request.pop('auth_token', None),
+						                                deadline_at,
+						                                **request)
+					except CommandExecutionError as e:
+						return e
+
+			return await asyncio.gather(*[send(request) for request in requests])
+
+		results = _async_run(send_all())
+
+	if any(not isinstance(result, CommandExecutionError) for result in results):
+		for resource in invalidate:
+			cache_invalidate(resource)
+
+	return results
+
+
+
+def _cassette_request(method, url, data, params):
+	"""
+	The key a request is matched on when replaying a cassette
+	"""
+	return json.dumps([method, url, params, data], sort_keys=True)
+
+
+
+def _cassette_load(path):
+	"""
+	Read the interactions of a cassette, grouped by request in the order
+	they were recorded
+	"""
+	if path not in CASSETTES:
+		interactions = {}
+		try:
+			with salt.utils.files.fopen(path, "rb") as _f:
+				for line in _f:
+					if not line.strip():
+						continue
+					interaction = json_loads(line)
+					request = _cassette_request(interaction['method'],
+					                            interaction['url'],
+					                            interaction['data'],
+					                            interaction['params'])
+					interactions.setdefault(request, []).append(interaction)
+		except (IOError, OSError, ValueError, KeyError) as e:
+			raise InvalidConfigError(
+				"Could not read rapyutaio cassette {0}: {1}".format(path, e)
+			)
+		CASSETTES[path] = interactions
+
+	return CASSETTES[path]
+
+
+
+def _cassette_replay(path, url, method, data, params):
+	"""
+	Serve a request from a cassette, after the recorded latency scaled by
+	``rapyutaio:cassette_latency``. Repeats of a request get its recorded
+	responses in turn, then the last one again.
+	"""
+	interactions = _cassette_load(path).get(_cassette_request(method, url, data, params))
+
+	if not interactions:
+		raise CommandExecutionError(
+			message="{0} {1} is not in the rapyutaio cassette {2}".format(method, url, path),
+			info={
+				"status": 404
+			}
+		)
+
+	with CASSETTE_LOCK:
+		interaction = interactions.pop(0) if len(interactions) > 1 else interactions[0]
+
+	latency = float(_config_get("rapyutaio:cassette_latency", 1.0))
+	if latency > 0:
+		time.sleep(interaction['elapsed'] * latency)
+
+	response = {
+		"status": interaction['status'],
+		"headers": dict(interaction['headers']),
+		"body": salt.utils.stringutils.to_bytes(interaction['body']),
+	}
+	if 'error' in interaction:
+		response['error'] = interaction['error']
+
+	return response
+
+
+
+def _cassette_record(path, url, header_dict, method, data, params, response, started, elapsed):
+	"""
+	Append a request and its response to a cassette, without credentials
+	"""
+	interaction = {
+		"started": started,
+		"elapsed": elapsed,
+		"method": method,
+		"url": url,
+		"params": params,
+		"data": data,
+		"request_headers": {
+			name: "REDACTED" if name.lower() in CASSETTE_REDACTED_HEADERS else value
+			for name, value
+			in header_dict.items()
+		},
+		"status": response.get('status'),
+		"headers": dict(response.get('headers') or {}),
+		"body": salt.utils.stringutils.to_unicode(response['body']),
+	}
+	if 'error' in response:
+		interaction['error'] = str(response['error'])
+
+	line = salt.utils.stringutils.to_bytes(json_dumps(interaction)) + b"\n"
+
+	with CASSETTE_LOCK:
+		with salt.utils.files.fopen(path, "ab") as _f:
+			if HAS_FCNTL:
+				# Job processes record into the same cassette
+				fcntl.flock(_f.fileno(), fcntl.LOCK_EX)
+			_f.write(line)
+
+
+
+def _query(url, header_dict, method="GET", data=None, params=None):
+	"""
+	Sends an HTTP request and returns the Salt response dict
+
+	With ``rapyutaio:cassette`` set, every request and response is recorded
+	to that file, or with ``rapyutaio:cassette_mode: replay`` served from it.
 	"""
 	log.debug("url: %s" % url)
-	log.debug("header_dict: %s" % header_dict)
 	log.debug("method: %s" % method)
 	log.debug("data: %s" % data)
 	log.debug("params: %s" % params)
 
-	if data is not None:
-		header_dict['Content-Type'] = "application/json"
+	deadline_check("sending {0} {1}".format(method, url))
 
-	response = salt.utils.http.query(url=url,
-	                                 header_dict=header_dict,
-	                                 method=method,
-	                                 data=salt.utils.json.dumps(data) if data is not None else None,
-	                                 params=params,
-	                                 status=True)
-	log.debug(response)
+	# The caller's headers may be shared with other requests
+	header_dict = dict(header_dict)
 
+	cassette = _config_get("rapyutaio:cassette")
+	if cassette and _config_get("rapyutaio:cassette_mode") == "replay":
+		return _cassette_replay(cassette, url, method, data, params)
+
+	header_dict['Accept-Encoding'] = "gzip"
+
+	started = time.time()
+	if _http_backend() == "aiohttp":
+		response = _async_run(_async_query(url, header_dict, method, data, params,
+		                                   deadline_at=DEADLINE.get()))
+	else:
+		opts = __opts__
+		remaining = deadline_remaining()
+		if remaining is not None:
+			# Only the remaining budget is left for this request
+			opts = dict(__opts__,
+			            http_request_timeout=remaining,
+			            http_connect_timeout=min(remaining, __opts__.get('http_connect_timeout', 20.0)))
+		response = salt.utils.http.query(url=url,
+		                                 header_dict=header_dict,
+		                                 method=method,
+		                                 data=json_dumps(data) if data is not None else None,
+		                                 params=params,
+		                                 status=True,
+		                                 headers=True,
+		                                 decode_body=False,
+		                                 opts=opts)
+
+		if remaining is not None and response.get('status', 599) == 599 and deadline_remaining() <= 0:
+			# Timed out because of the deadline rather than the server
+			response['status'] = 408
+			response['error'] = "Deadline exceeded: {0}".format(response['error'])
+	elapsed = time.time() - started
+
+	# Older Salt versions and some backends leave the body compressed
+	body = salt.utils.stringutils.to_bytes(response.get('body') or b'')
+	if body[:2] == b'\x1f\x8b':
+		body = gzip.decompress(body)
+	response['body'] = body
+
+	log.debug("response: status %s, %d bytes in %.3fs" % (response.get('status'), len(body), elapsed))
+
+	if cassette:
+		_cassette_record(cassette, url, header_dict, method, data, params, response, started, elapsed)
+
+	return response
+
+
+
+def _raise_for_error(response):
+	"""
+	Raises a CommandExecutionError carrying the HTTP status if the
+	response is an error
+	"""
 	if 'error' in response:
 		raise CommandExecutionError(
 			message=response['error'],
@@ -188,74 +1106,737 @@ def _send_request(url, header_dict={}, method="GET", data=None, params=None):
 			}
 		)
 
-	if response['body'] != '':
-		return salt.utils.json.loads(response['body'])
+
+
+def _send_request(url, header_dict=None, method="GET", data=None, params=None):
+	"""
+	Sends an HTTP request, parses the result, raises an exception on error
+	"""
+	header_dict = dict(header_dict or {})
+
+	if data is not None:
+		header_dict['Content-Type'] = "application/json"
+
+	response = _query(url, header_dict, method, data, params)
+	_raise_for_error(response)
+
+	if response['body']:
+		return json_loads(response['body'])
 	else:
 		return {}
 
 
 
+def _cache_connect():
+	"""
+	Open the listing cache shared by every Salt job process on the minion.
+
+	The database is in WAL mode so readers are never blocked by the
+	process refreshing a listing, and writers wait for each other.
+	"""
+	cache_dir = os.path.join(__opts__['cachedir'], 'rapyutaio')
+	os.makedirs(cache_dir, exist_ok=True)
+
+	conn = sqlite3.connect(os.path.join(cache_dir, 'cache.sqlite'),
+	                       timeout=CACHE_LOCK_TIMEOUT,
+	                       isolation_level=None)
+	conn.execute("PRAGMA journal_mode=WAL")
+	conn.execute("PRAGMA synchronous=NORMAL")
+	conn.execute(
+		"CREATE TABLE IF NOT EXISTS listings ("
+		"  resource TEXT NOT NULL,"
+		"  key TEXT NOT NULL,"
+		"  stored_at REAL NOT NULL,"
+		"  etag TEXT,"
+		"  last_modified TEXT,"
+		"  digest TEXT NOT NULL,"
+		"  body BLOB NOT NULL,"
+		"  PRIMARY KEY (resource, key)"
+		")"
+	)
+	return conn
+
+
+
+def _cache_ttl(resource):
+	"""
+	Seconds a cached listing is used without asking rapyuta.io, from
+	``rapyutaio:cache_ttl`` or the defaults in CACHE_TTL
+	"""
+	ttls = _config_get("rapyutaio:cache_ttl", {}) or {}
+	return float(ttls.get(resource, CACHE_TTL.get(resource, 0)))
+
+
+
+def _cache_load(resource, key):
+	"""
+	Read a listing from the on-disk cache. The body is left unparsed until
+	it is needed.
+	"""
+	try:
+		with contextlib.closing(_cache_connect()) as conn:
+			row = conn.execute(
+				"SELECT stored_at, etag, last_modified, digest, body"
+				" FROM listings WHERE resource = ? AND key = ?",
+				(resource, key)
+			).fetchone()
+	except sqlite3.Error as e:
+		log.warning("rapyutaio listing cache unavailable: %s" % e)
+		return None
+
+	if row is None:
+		return None
+
+	return {
+		"stored_at": row[0],
+		"etag": row[1],
+		"last_modified": row[2],
+		"digest": row[3],
+		"raw": bytes(row[4]),
+		"body": None,
+	}
+
+
+
+def _cache_stamp(resource, key):
+	"""
+	Return when a listing in the on-disk cache was last confirmed fresh and
+	the digest of its body, without reading the body. None if it isn't
+	there or the cache can't be read.
+	"""
+	try:
+		with contextlib.closing(_cache_connect()) as conn:
+			return conn.execute(
+				"SELECT stored_at, digest FROM listings WHERE resource = ? AND key = ?",
+				(resource, key)
+			).fetchone()
+	except sqlite3.Error as e:
+		log.warning("rapyutaio listing cache unavailable: %s" % e)
+		return None
+
+
+
+def _cache_store(resource, key, entry, raw=None):
+	"""
+	Write a listing to the on-disk cache. Without ``raw`` only the time it
+	was last confirmed fresh is updated.
+	"""
+	try:
+		with contextlib.closing(_cache_connect()) as conn:
+			if raw is None:
+				conn.execute(
+					"UPDATE listings SET stored_at = ? WHERE resource = ? AND key = ?",
+					(entry['stored_at'], resource, key)
+				)
+			else:
+				conn.execute(
+					"INSERT OR REPLACE INTO listings"
+					" (resource, key, stored_at, etag, last_modified, digest, body)"
+					" VALUES (?, ?, ?, ?, ?, ?, ?)",
+					(resource, key, entry['stored_at'], entry['etag'],
+					 entry['last_modified'], entry['digest'], sqlite3.Binary(raw))
+				)
+	except sqlite3.Error as e:
+		log.warning("rapyutaio listing cache unavailable: %s" % e)
+
+
+
+def _entry_body(entry):
+	"""
+	Return the parsed body of a cache entry, parsing it on first use
+	"""
+	if entry['body'] is None:
+		with CACHE_ENTRY_LOCK:
+			# Another thread may have parsed it while this one waited
+			if entry['body'] is None:
+				entry['body'] = json_loads(entry.pop('raw')) if entry['raw'] else {}
+	return entry['body']
+
+
+
+def cache_invalidate(resource, everywhere=True):
+	"""
+	Mark every cached listing of a resource as stale so the next read
+	revalidates it with rapyuta.io.
+
+	Unless ``everywhere`` is False this also applies to the on-disk cache
+	and the engine's mirror, not just this process.
+	"""
+	# Copied, as other threads may be adding to it
+	for cache_key, entry in list(RESPONSE_CACHE.items()):
+		if cache_key[0] == resource:
+			entry['stored_at'] = 0
+
+	if not everywhere:
+		return
+
+	try:
+		with contextlib.closing(_cache_connect()) as conn:
+			conn.execute("UPDATE listings SET stored_at = 0 WHERE resource = ?",
+			             (resource,))
+	except sqlite3.Error as e:
+		log.warning("rapyutaio listing cache unavailable: %s" % e)
+
+	_mirror_call({"invalidate": resource})
+
+
+
+def manifest_cache_get(key):
+	"""
+	Return a copy of the manifest parsed under ``key``, or None
+	"""
+	if SNAPSHOT_RECORDING.get('current') is not None:
+		# Fetch everything while recording a snapshot
+		return None
+
+	manifest = MANIFESTS.get(key)
+
+	if manifest is None:
+		entry = _cache_load("manifest", key)
+		if entry is None:
+			return None
+		manifest = MANIFESTS.setdefault(key, _entry_body(entry))
+
+	return copy.deepcopy(manifest)
+
+
+
+def manifest_cache_set(key, manifest):
+	"""
+	Keep a parsed manifest under ``key``. The key must change whenever the
+	manifest would, so entries are never invalidated.
+	"""
+	MANIFESTS[key] = copy.deepcopy(manifest)
+	_cache_store("manifest", key, {
+		"stored_at": time.time(),
+		"etag": None,
+		"last_modified": None,
+		"digest": key,
+	}, raw=salt.utils.stringutils.to_bytes(json_dumps(manifest)))
+
+
+
+def manifest_digest(manifest):
+	"""
+	Content hash of a manifest, independent of key order
+	"""
+	return hashlib.sha1(salt.utils.stringutils.to_bytes(
+		json.dumps(manifest, sort_keys=True, separators=(",", ":"))
+	)).hexdigest()
+
+
+
+def mirror_socket_path():
+	"""
+	Path of the Unix socket the rapyutaio engine serves its mirror on
+	"""
+	return os.path.join(__opts__['cachedir'], 'rapyutaio', 'mirror.sock')
+
+
+
+def mirror_serve():
+	"""
+	Called by the rapyutaio engine so that this process fetches listings
+	itself instead of asking the mirror it is serving
+	"""
+	global SERVING_MIRROR
+	SERVING_MIRROR = True
+
+
+
+def mirror_lookup(disk_key, known_digest=None):
+	"""
+	Used by the rapyutaio engine to answer a mirror request. Returns the
+	listing's digest and its serialised body, or an empty body if the
+	client already has that digest. Returns None if the listing isn't
+	mirrored or is waiting to be refreshed.
+	"""
+	for cache_key, entry in list(RESPONSE_CACHE.items()):
+		if "|".join(cache_key[1:]) == disk_key:
+			break
+	else:
+		return None
+
+	if not entry['stored_at']:
+		return None
+
+	if entry['digest'] == known_digest:
+		return entry['digest'], b""
+
+	digest, body = MIRROR_BODIES.get(disk_key, (None, None))
+	if digest != entry['digest']:
+		body = salt.utils.stringutils.to_bytes(json_dumps(_entry_body(entry)))
+		MIRROR_BODIES[disk_key] = (entry['digest'], body)
+
+	return entry['digest'], body
+
+
+
+def _mirror_call(message):
+	"""
+	Send a request to the rapyutaio engine's mirror and return the reply,
+	or None if no engine is running
+	"""
+	if SERVING_MIRROR or not hasattr(socket, "AF_UNIX"):
+		return None
+
+	path = mirror_socket_path()
+	if not os.path.exists(path):
+		return None
+
+	try:
+		with contextlib.closing(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)) as sock:
+			sock.settimeout(MIRROR_TIMEOUT)
+			sock.connect(path)
+			sock.sendall(salt.utils.stringutils.to_bytes(json_dumps(message)))
+			sock.shutdown(socket.SHUT_WR)
+
+			chunks = []
+			chunk = sock.recv(65536)
+			while chunk:
+				chunks.append(chunk)
+				chunk = sock.recv(65536)
+	except OSError as e:
+		log.debug("rapyutaio mirror unavailable: %s" % e)
+		return None
+
+	return b"".join(chunks)
+
+
+
+def _mirror_listing(cache_key):
+	"""
+	Return a listing from the rapyutaio engine's mirror, or None.
+
+	Only the digest is exchanged when this process already holds the same
+	listing, in which case the cached object is returned.
+	"""
+	entry = RESPONSE_CACHE.get(cache_key)
+	known_digest = entry['digest'] if entry is not None else None
+
+	reply = _mirror_call({"get": "|".join(cache_key[1:]), "digest": known_digest})
+	if not reply:
+		return None
+
+	digest, _, raw = reply.partition(b"\n")
+	digest = digest.decode()
+
+	if not raw and entry is not None and digest == entry['digest']:
+		entry['stored_at'] = time.time()
+		return _entry_body(entry)
+
+	entry = {
+		"stored_at": time.time(),
+		"etag": None,
+		"last_modified": None,
+		"digest": digest,
+		"body": json_loads(raw) if raw else {},
+	}
+	RESPONSE_CACHE[cache_key] = entry
+	return entry['body']
+
+
+
+def _fresh_listing(cache_key):
+	"""
+	Return a cached listing younger than its resource TTL, or None.
+
+	The on-disk cache shared with other job processes is checked first, as
+	they may have fetched a newer listing or invalidated it since this
+	process last saw it. Job processes are forked from the proxy, so their
+	copy of the listing can be older than they are. The listing held in
+	this process is used when it is the same as the one on disk.
+	"""
+	resource = cache_key[0]
+	disk_key = "|".join(cache_key[1:])
+
+	entry = RESPONSE_CACHE.get(cache_key)
+	stamp = _cache_stamp(resource, disk_key)
+
+	if stamp is not None and entry is not None and stamp[1] == entry['digest']:
+		entry['stored_at'] = stamp[0]
+	elif stamp is not None:
+		entry = _cache_load(resource, disk_key)
+		if entry is None:
+			return None
+		RESPONSE_CACHE[cache_key] = entry
+	elif entry is None:
+		return None
+
+	if time.time() - entry['stored_at'] < _cache_ttl(resource):
+		log.debug("%s is fresh, using cached response" % cache_key[2])
+		return _entry_body(entry)
+
+	return None
+
+
+
+def _send_cached_request(cache_key, url, header_dict, params=None):
+	"""
+	Sends a GET request for a listing with the validators (ETag,
+	Last-Modified) of the cached response, if there is one.
+
+	If the server replies 304 Not Modified, or sends a body identical to
+	the cached one, the cached parsed object is returned as-is, so callers
+	may rely on its identity to reuse anything derived from it. The
+	returned object is shared and must not be modified.
+	"""
+	resource = cache_key[0]
+	disk_key = "|".join(cache_key[1:])
+	now = time.time()
+
+	entry = RESPONSE_CACHE.get(cache_key)
+
+	if entry is not None:
+		if entry['etag']:
+			header_dict['If-None-Match'] = entry['etag']
+		if entry['last_modified']:
+			header_dict['If-Modified-Since'] = entry['last_modified']
+
+	response = _query(url, header_dict, "GET", None, params)
+
+	if entry is not None and response.get('status') == 304:
+		log.debug("%s not modified, using cached response" % url)
+		entry['stored_at'] = now
+		_cache_store(resource, disk_key, entry)
+		return _entry_body(entry)
+
+	_raise_for_error(response)
+
+	digest = hashlib.sha1(response['body']).hexdigest()
+
+	if entry is not None and entry['digest'] == digest:
+		log.debug("%s unchanged, using cached response" % url)
+		entry['stored_at'] = now
+		_cache_store(resource, disk_key, entry)
+		return _entry_body(entry)
+
+	headers = {
+		key.lower(): value
+		for key, value
+		in (response.get('headers') or {}).items()
+	}
+	entry = {
+		"stored_at": now,
+		"etag": headers.get('etag'),
+		"last_modified": headers.get('last-modified'),
+		"digest": digest,
+		"body": json_loads(response['body']) if response['body'] else {},
+	}
+	RESPONSE_CACHE[cache_key] = entry
+	_cache_store(resource, disk_key, entry, raw=response['body'])
+
+	return entry['body']
+
+
+
+def _snapshot_key(url, params=None):
+	"""
+	The URL a GET request is recorded under in a snapshot
+	"""
+	if params:
+		url += "?" + urlencode(sorted(params.items()), doseq=True)
+	return url
+
+
+
+def _offline_snapshot():
+	"""
+	Return the responses of the snapshot named by ``rapyutaio:snapshot``,
+	or None if requests should go to rapyuta.io
+	"""
+	path = _config_get("rapyutaio:snapshot")
+
+	if not path:
+		return None
+
+	if path not in SNAPSHOTS:
+		try:
+			with salt.utils.files.fopen(path, "rb") as _f:
+				SNAPSHOTS[path] = json_loads(_f.read())['responses']
+		except (IOError, OSError, ValueError, KeyError) as e:
+			raise InvalidConfigError(
+				"Could not read rapyutaio snapshot {0}: {1}".format(path, e)
+			)
+
+	return SNAPSHOTS[path]
+
+
+
+def offline():
+	"""
+	Whether requests are answered from a snapshot, so nothing can be
+	changed in rapyuta.io
+	"""
+	return bool(_config_get("rapyutaio:snapshot"))
+
+
+
+def _snapshot_replay(responses, url, method="GET", params=None):
+	"""
+	Answer a request from a snapshot. Only reads can be answered.
+	"""
+	if method != "GET":
+		raise CommandExecutionError(
+			"rapyutaio is offline, serving a snapshot: can't {0} {1}".format(method, url)
+		)
+
+	key = _snapshot_key(url, params)
+	if key not in responses:
+		raise CommandExecutionError(
+			message="{0} is not in the rapyutaio snapshot".format(key),
+			info={
+				"status": 404
+			}
+		)
+
+	return responses[key]
+
+
+
+def _snapshot_record(url, params, response_body):
+	"""
+	Add a GET response to the snapshot being recorded, if any
+	"""
+	responses = SNAPSHOT_RECORDING.get('current')
+	if responses is not None:
+		responses[_snapshot_key(url, params)] = response_body
+	return response_body
+
+
+
+@contextlib.contextmanager
+def snapshot_record():
+	"""
+	Collect the responses to every GET request made in the block, to be
+	written out with snapshot_write()
+	"""
+	responses = {}
+	SNAPSHOT_RECORDING['current'] = responses
+	try:
+		yield responses
+	finally:
+		SNAPSHOT_RECORDING.pop('current', None)
+
+
+
+def snapshot_write(path, responses, project_id=None):
+	"""
+	Write recorded responses to a snapshot file for offline mode
+	"""
+	snapshot = {
+		"recorded_at": time.time(),
+		"project_id": project_id or _config_get("rapyutaio:project_id"),
+		"responses": responses,
+	}
+	with salt.utils.files.fopen(path, "wb") as _f:
+		_f.write(salt.utils.stringutils.to_bytes(json_dumps(snapshot)))
+
+
+
+def fetch_url(url, header_dict=None):
+	"""
+	GET and parse a JSON document that needs no rapyuta.io credentials,
+	such as a package manifest. Served from the snapshot in offline mode.
+	"""
+	responses = _offline_snapshot()
+	if responses is not None:
+		return _snapshot_replay(responses, url)
+
+	return _snapshot_record(url, None, _send_request(url=url,
+	                                                 header_dict=dict(header_dict or {})))
+
+
+
 def api_request(url,
                 http_method="GET",
-                header_dict={},
+                header_dict=None,
                 data=None,
                 params=None,
                 project_id=None,
-                auth_token=None):
+                auth_token=None,
+                cache=None,
+                invalidate=None):
 	"""
 	Wrapper for HTTP requests to IO and handle authentication and tokens
+
+	cache
+		Name of the listing resource (``account``, ``catalog``,
+		``networks``, ``deployments``, ``devices``) the URL returns. GET responses for
+		these are cached for the resource's TTL (``rapyutaio:cache_ttl``),
+		then revalidated with conditional requests.
+
+	invalidate
+		Name of the listing resource a write request changes. Its cached
+		listings are marked stale once the request succeeds.
+
+	Identical GET requests made at the same time by threads of this process
+	are sent once, and every caller gets the same parsed response, which
+	must not be modified. If the request fails because the deadline of the
+	caller that sent it passed, the others send it again. Other processes
+	fetching the same cached listing wait for this one and read it from
+	the on-disk cache.
+	"""
+	if http_method != "GET":
+		return _api_request(url, http_method, header_dict, data, params,
+		                    project_id, auth_token, cache, invalidate)
+
+	flight_key = (
+		str(project_id or _config_get("rapyutaio:project_id")),
+		auth_token,
+		url,
+		repr(sorted((params or {}).items())),
+	)
+
+	while True:
+		with IN_FLIGHT_LOCK:
+			future = IN_FLIGHT.get(flight_key)
+			leader = future is None
+			if leader:
+				future = IN_FLIGHT[flight_key] = concurrent.futures.Future()
+
+		if leader:
+			break
+
+		try:
+			response_body = future.result(timeout=deadline_remaining())
+		except concurrent.futures.TimeoutError:
+			deadline_check("waiting for GET {0}".format(url))
+			continue
+
+		if response_body is not IN_FLIGHT_RETRY:
+			return response_body
+
+		# The request ran out of its caller's time, not necessarily ours
+		deadline_check("waiting for GET {0}".format(url))
+
+	try:
+		response_body = _api_request(url, http_method, header_dict, data, params,
+		                             project_id, auth_token, cache, invalidate)
+	except BaseException as e:
+		with IN_FLIGHT_LOCK:
+			IN_FLIGHT.pop(flight_key, None)
+
+		remaining = deadline_remaining()
+		if remaining is not None and remaining <= 0:
+			# However it failed, the waiters may have time to try again
+			future.set_result(IN_FLIGHT_RETRY)
+		else:
+			future.set_exception(e)
+		raise
+
+	with IN_FLIGHT_LOCK:
+		IN_FLIGHT.pop(flight_key, None)
+	future.set_result(response_body)
+
+	return response_body
+
+
+
+def _api_request(url,
+                 http_method,
+                 header_dict,
+                 data,
+                 params,
+                 project_id,
+                 auth_token,
+                 cache,
+                 invalidate):
+	"""
+	The request behind api_request()
 	"""
 	log.debug("rapyutaio.api_request() called...")
-	project_id = project_id or __salt__['config.get']("rapyutaio:project_id")
+	project_id = project_id or _config_get("rapyutaio:project_id")
 
 	if not project_id:
 		raise InvalidConfigError("No rapyutaio project_id found")
 
-	generated_auth_token = None
+	responses = _offline_snapshot()
+	if responses is not None:
+		return _snapshot_replay(responses, url, http_method, params)
 
-	if auth_token is None:
-		# Get the cached token with its expiryAt
-		cached_token = salt.utils.sdb.sdb_get('sdb://rapyutaio/auth_token', __opts__, None)
-
-		log.debug("cached_token: {}".format(str(cached_token)))
-
-		if cached_token:
-			try:
-				# Trim off the nanoseconds when parsing the datetime
-				expiry = datetime.strptime(cached_token['expiryAt'][:19], '%Y-%m-%dT%H:%M:%S')
+	if cache and http_method == "GET":
+		cache_key = (cache, str(project_id), url, repr(sorted((params or {}).items())))
 
-				if expiry >= datetime.utcnow():
-					generated_auth_token = cached_token['token']
-			except KeyError:
-				pass
+		# A mirrored or fresh listing needs neither a token nor a request
+		listing = _mirror_listing(cache_key)
+		if listing is None:
+			listing = _fresh_listing(cache_key)
+		if listing is not None:
+			return _snapshot_record(url, params, listing)
 
-	if auth_token is None and generated_auth_token is None:
-		# cached token has expired
-		generated_auth_token = _renew_token()['token']
+	generated_auth_token = None
 
-	header_dict = _header_dict(project_id, auth_token or generated_auth_token)
+	if auth_token is None:
+		generated_auth_token = login()
+
+	if cache and http_method == "GET":
+		def send(header_dict):
+			with _flight_lock(cache_key):
+				# Another process may have fetched it while this one waited
+				listing = _fresh_listing(cache_key)
+				if listing is not None:
+					return listing
+
+				return _send_cached_request(cache_key,
+				                            url=url,
+				                            header_dict=header_dict,
+				                            params=params)
+	else:
+		def send(header_dict):
+			return _send_request(url=url,
+			                     header_dict=header_dict,
+			                     method=http_method,
+			                     data=data,
+			                     params=params)
 
 	# first request attempt
 	try:
-		return _send_request(url=url,
-		                     header_dict=header_dict,
-		                     method=http_method,
-		                     data=data,
-		                     params=params)
+		response_body = send(_header_dict(project_id, auth_token or generated_auth_token))
 	except CommandExecutionError as e:
-		if e.info['status'] == 401:
+		if e.info['status'] == 401 and auth_token is None:
 			# HTTP 401: Unauthorized
-			if auth_token is None:
-				# only generate a new token if the first was
-				# generated from a login
-				generated_auth_token = _renew_token()['token']
-				header_dict = _header_dict(project_id, generated_auth_token)
-				return _send_request(url=url,
-				                     header_dict=header_dict,
-				                     method=http_method,
-				                     data=data,
-				                     params=params)
-		raise e
+			# only generate a new token if the first was
+			# generated from a login
+			generated_auth_token = _renew_token(rejected_token=generated_auth_token)['token']
+			response_body = send(_header_dict(project_id, generated_auth_token))
+		else:
+			raise e
+
+	if invalidate is not None:
+		cache_invalidate(invalidate)
+
+	if http_method == "GET":
+		_snapshot_record(url, params, response_body)
+
+	return response_body
+
+
+
+def find_device(name, project_id=None):
+	"""
+	Return the summary of a device from the cached device listing, or None.
+
+	The name index is shared by every proxy in the process and rebuilt
+	only when the listing changes.
+	"""
+	response_body = api_request(DEVICE_API_PATH,
+	                            project_id=project_id,
+	                            cache="devices")
+
+	return listing_index("devices", response_body['response']['data'], _device_index).get(name)
+
+
+
+def _device_index(listing):
+	"""
+	The devices of a listing by name, keeping the first of several that
+	share a name
+	"""
+	index = {}
+	for device in listing:
+		index.setdefault(device['name'], device)
+	return index
 
 
 
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark of the JSON codec and gzip transfer of a device listing
+
+Times parsing and serialising a listing with the standard library, Salt's
+JSON module and the fastest codec the utils module found, then fetching
+it from the local stand-in server the old way (Salt's HTTP client, no
+compression, salt.utils.json) and through rapyutaio._send_request.
+
+	$ python tests/bench_json_codec.py
+	$ python tests/bench_json_codec.py --listing devices.json
+
+``--listing`` takes a recorded device listing response body, otherwise a
+listing of ``--devices`` generated devices is used.
+"""
+import argparse
+import gzip
+import json
+import tempfile
+import timeit
+import salt.utils.http
+import salt.utils.json
+import standin
+
+
+
+def best(fn, repeat):
+	"""
+	Fastest of ``repeat`` runs of ``fn``, in milliseconds
+	"""
+	return min(timeit.repeat(fn, number=1, repeat=repeat)) * 1000
+
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+	parser.add_argument("--listing", help="recorded device listing response")
+	parser.add_argument("--devices", type=int, default=10000)
+	parser.add_argument("--repeat", type=int, default=10)
+	args = parser.parse_args()
+
+	if args.listing:
+		with open(args.listing, "rb") as _f:
+			raw = _f.read()
+	else:
+		raw = json.dumps(standin.device_listing(args.devices)).encode("utf-8")
+	listing = json.loads(raw)
+
+	utils = standin.load_utils(tempfile.mkdtemp())
+	codec = "orjson" if utils.HAS_ORJSON else "ujson" if utils.HAS_UJSON else "json"
+
+	print("{0} devices, {1:.0f} KiB, {2:.0f} KiB gzipped".format(
+		len(listing['response']['data']),
+		len(raw) / 1024,
+		len(gzip.compress(raw)) / 1024,
+	))
+	print()
+	print("{0:<28}{1:>10}".format("", "ms"))
+	for label, fn in (
+		("json.loads", lambda: json.loads(raw)),
+		("salt.utils.json.loads", lambda: salt.utils.json.loads(raw.decode("utf-8"))),
+		("json_loads ({0})".format(codec), lambda: utils.json_loads(raw)),
+		("json.dumps", lambda: json.dumps(listing)),
+		("salt.utils.json.dumps", lambda: salt.utils.json.dumps(listing)),
+		("json_dumps ({0})".format(codec), lambda: utils.json_dumps(listing)),
+	):
+		print("{0:<28}{1:>10.1f}".format(label, best(fn, args.repeat)))
+
+	with standin.StandIn({"/devices/": raw}) as server:
+		url = server.url + "/devices/"
+
+		def uncompressed():
+			response = salt.utils.http.query(url=url,
+			                                 header_dict={"accept": "application/json"},
+			                                 status=True,
+			                                 decode_body=False,
+			                                 opts=utils.__opts__)
+			return salt.utils.json.loads(response['body'])
+
+		print()
+		for label, fn in (
+			("fetch, uncompressed", uncompressed),
+			("fetch, _send_request", lambda: utils._send_request(url, {"accept": "application/json"})),
+		):
+			print("{0:<28}{1:>10.1f}".format(label, best(fn, args.repeat)))
+
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of rapyutaio proxy startup and first-call latency
+
+Times loading the config execution module the way the utils module does,
+on first use and on its own, against loading every minion module. Then
+runs the proxy's init() against the local stand-in server, and times the
+first job's device listing after it, with and without warm-up.
+
+	$ python tests/bench_proxy_startup.py
+	$ python tests/bench_proxy_startup.py --latency 0.2 --devices 10000
+
+``--latency`` is the seconds the stand-in waits before each response.
+"""
+import argparse
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import salt.loader
+import standin
+
+
+
+def timed(fn):
+	"""
+	Call ``fn`` and return the seconds it took, in milliseconds
+	"""
+	started = time.perf_counter()
+	fn()
+	return (time.perf_counter() - started) * 1000
+
+
+
+def load_config(loader):
+	"""
+	Print the milliseconds to a usable config.get and how much the peak
+	RSS grew in KiB, loading only the config module as the utils module
+	does, or forcing the loader to load every minion module
+	"""
+	opts = standin.minion_opts(tempfile.mkdtemp())
+	utils = standin.load_module("_utils/rapyutaio.py", "rapyutaio_loader", __opts__=opts)
+	rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+	def load_all():
+		# The loader is lazy too: have it load every module, as a minion
+		# does once it has run a few different jobs
+		mods = salt.loader.minion_mods(opts)
+		mods._load_all()
+		mods['config.get']("rapyutaio:project_id")
+
+	if loader == "lazy":
+		elapsed = timed(lambda: utils._config_get("rapyutaio:project_id"))
+	else:
+		elapsed = timed(load_all)
+
+	print(elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss)
+
+
+
+def loader_times(loader):
+	"""
+	Run load_config() in a fresh interpreter, so neither loader benefits
+	from the other's imports
+	"""
+	output = subprocess.run([sys.executable, __file__, "--load-config", loader],
+	                        check=True,
+	                        stdout=subprocess.PIPE,
+	                        universal_newlines=True).stdout
+	elapsed, rss = output.split()[-2:]
+	return float(elapsed), int(rss) / 1024
+
+
+
+def start_proxy(url, warmup):
+	"""
+	Load the utils, execution and proxy modules with a fresh cache, pointed
+	at the stand-in server. Returns the proxy module and its ``__salt__``.
+	"""
+	cachedir = tempfile.mkdtemp()
+	config = {"rapyutaio:warmup": warmup}
+	utils = standin.load_utils(cachedir, config, name="rapyutaio_startup")
+	for shared in (utils.RESPONSE_CACHE, utils.LISTING_INDEXES, utils.IN_FLIGHT):
+		shared.clear()
+
+	utils_functions, salt_functions, _ = standin.load_salt_modules(utils, url)
+	proxy = standin.load_module("_proxy/rapyutaio.py",
+	                            "rapyutaio_proxy",
+	                            __opts__=utils.__opts__,
+	                            __utils__=utils_functions,
+	                            __salt__=salt_functions)
+	standin.point_at(proxy, url)
+
+	return proxy, salt_functions
+
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+	parser.add_argument("--latency", type=float, default=0.05)
+	parser.add_argument("--devices", type=int, default=1000)
+	parser.add_argument("--repeat", type=int, default=5)
+	parser.add_argument("--load-config", choices=("lazy", "full"), help=argparse.SUPPRESS)
+	args = parser.parse_args()
+
+	if args.load_config:
+		load_config(args.load_config)
+		return
+
+	print("{0:<36}{1:>10}{2:>12}".format("", "ms", "+RSS MiB"))
+	for label, loader in (
+		("config.get, config module only", "lazy"),
+		("config.get, every minion module", "full"),
+	):
+		elapsed, rss = loader_times(loader)
+		print("{0:<36}{1:>10.1f}{2:>12.1f}".format(label, elapsed, rss))
+
+	routes = {
+		"/api/user/me/get": {"organization": {"guid": "org-standin"}},
+		"/api/organization/org-standin/get": {"guid": "org-standin"},
+		"/v2/catalog": {"services": []},
+		"/routednetwork": [],
+		"/deployment/list": [],
+		"/api/device-manager/v0/devices/": standin.device_listing(args.devices),
+	}
+
+	with standin.StandIn(routes, delay=args.latency) as server:
+		for label, warmup in (
+			("no warm-up", []),
+			("default warm-up", list(standin.load_module("_proxy/rapyutaio.py", "rapyutaio_proxy").WARMUP)),
+		):
+			init_times = []
+			first_call_times = []
+			for _ in range(args.repeat):
+				proxy, salt_functions = start_proxy(server.url, warmup)
+				init_times.append(timed(lambda: proxy.init(proxy.__opts__)))
+				first_call_times.append(timed(salt_functions['rapyutaio.get_devices']))
+
+			print()
+			print("{0:<36}{1:>10.1f}".format("init(), " + label, statistics.median(init_times)))
+			print("{0:<36}{1:>10.1f}".format("first get_devices(), " + label, statistics.median(first_call_times)))
+
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+import pytest
+import standin
+
+
+
+@pytest.fixture
+def server():
+	with standin.StandIn() as server:
+		yield server
+
+
+
+@pytest.fixture(params=["salt", "aiohttp"])
+def utils(request, tmp_path):
+	utils = standin.load_utils(str(tmp_path), {"rapyutaio:http_backend": request.param})
+	if utils._http_backend() != request.param:
+		pytest.skip("aiohttp is not installed")
+	yield utils
+	utils.RESPONSE_CACHE.clear()
+	utils.IN_FLIGHT.clear()
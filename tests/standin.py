@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""
+A local stand-in for the rapyuta.io API, and a loader for the rapyutaio
+utils module outside of Salt, shared by the tests and benchmarks
+"""
+import collections
+import functools
+import gzip
+import http.server
+import importlib.util
+import json
+import os
+import threading
+import time
+import salt.config
+import salt.utils.data
+
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The hosts the modules send requests to, all answered by the stand-in
+API_HOSTS = (
+	"https://garip.apps.rapyuta.io",
+	"https://gacatalog.apps.rapyuta.io",
+	"https://gaapiserver.apps.rapyuta.io",
+)
+
+
+
+class StandIn(http.server.ThreadingHTTPServer):
+	"""
+	Serves JSON bodies by path on a free localhost port, from a thread.
+
+	``routes`` maps a path to a JSON-serialisable body, or to a callable
+	returning one. Every request waits ``delay`` seconds before it is
+	answered, and ``hits`` counts the requests for each path.
+	"""
+	daemon_threads = True
+
+	def __init__(self, routes=None, delay=0):
+		super().__init__(("127.0.0.1", 0), _Handler)
+		self.routes = dict(routes or {})
+		self.delay = delay
+		self.hits = collections.Counter()
+		self.hits_lock = threading.Lock()
+		self.url = "http://127.0.0.1:{0}".format(self.server_address[1])
+
+	def __enter__(self):
+		threading.Thread(target=self.serve_forever, daemon=True).start()
+		return self
+
+	def __exit__(self, *exc_info):
+		self.shutdown()
+		self.server_close()
+
+
+
+@functools.lru_cache(maxsize=32)
+def _gzip(body):
+	"""
+	Compress a body once, as a server caching its compressed responses would
+	"""
+	return gzip.compress(body, compresslevel=6)
+
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+	def log_message(self, *args):
+		pass
+
+	def _answer(self):
+		path = self.path.split("?")[0]
+		with self.server.hits_lock:
+			self.server.hits[path] += 1
+
+		if self.server.delay:
+			time.sleep(self.server.delay)
+
+		if path not in self.server.routes:
+			self.send_error(404)
+			return
+
+		body = self.server.routes[path]
+		if callable(body):
+			body = body()
+		if not isinstance(body, bytes):
+			body = json.dumps(body).encode("utf-8")
+
+		self.send_response(200)
+		self.send_header("Content-Type", "application/json")
+		if "gzip" in self.headers.get("Accept-Encoding", ""):
+			body = _gzip(body)
+			self.send_header("Content-Encoding", "gzip")
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	do_GET = _answer
+	do_POST = _answer
+	do_PUT = _answer
+
+
+
+def load_module(path, name, **dunders):
+	"""
+	Import one of the salt modules of this repo by path, with the given
+	loader dunders
+	"""
+	spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT, path))
+	module = importlib.util.module_from_spec(spec)
+	spec.loader.exec_module(module)
+	for key, value in dunders.items():
+		setattr(module, key, value)
+	return module
+
+
+
+def minion_opts(cachedir, **overrides):
+	"""
+	Default minion opts with the cache in ``cachedir``
+	"""
+	opts = salt.config.DEFAULT_MINION_OPTS.copy()
+	opts.update({
+		"id": "myproxy",
+		"cachedir": cachedir,
+		"extension_modules": os.path.join(cachedir, "extmods"),
+		"grains": {},
+		"pillar": {},
+	})
+	opts.update(overrides)
+	return opts
+
+
+
+def load_utils(cachedir, config=None, name="rapyutaio_utils"):
+	"""
+	Load the rapyutaio utils module with its config read from ``config``
+	rather than the minion's, and logged in with a fixed token
+	"""
+	config = dict({
+		"rapyutaio:project_id": "project-standin",
+		"rapyutaio:http_backend": "salt",
+	}, **(config or {}))
+
+	utils = load_module("_utils/rapyutaio.py",
+	                    name,
+	                    __opts__=minion_opts(cachedir))
+	utils.__salt__ = {
+		"config.get": lambda key, default=None: config.get(key, default),
+	}
+	utils.TOKEN['current'] = {
+		"token": "standin-token",
+		"renewAt": time.time() + 3600,
+	}
+	return utils
+
+
+
+def load_salt_modules(utils, url=None):
+	"""
+	Load the execution and state modules on top of a loaded utils module,
+	as the Salt loader would. Returns their ``__utils__`` and ``__salt__``
+	and the state module. With ``url`` every module sends its requests to
+	the stand-in server there.
+	"""
+	utils_functions = {
+		"rapyutaio." + name: getattr(utils, name)
+		for name
+		in dir(utils)
+		if not name.startswith("_") and callable(getattr(utils, name))
+	}
+	utils_functions["data.recursive_diff"] = salt.utils.data.recursive_diff
+
+	salt_functions = {
+		"config.get": utils.__salt__['config.get'],
+		"config.option": lambda key, default=None: default,
+	}
+	module = load_module("_modules/rapyutaio.py",
+	                     utils.__name__ + "_module",
+	                     __opts__=dict(utils.__opts__, test=False),
+	                     __utils__=utils_functions,
+	                     __salt__=salt_functions)
+	salt_functions.update({
+		"rapyutaio." + name: getattr(module, name)
+		for name
+		in dir(module)
+		if not name.startswith("_") and callable(getattr(module, name))
+	})
+
+	states = load_module("_states/rapyutaio.py",
+	                     utils.__name__ + "_states",
+	                     __opts__=module.__opts__,
+	                     __utils__=utils_functions,
+	                     __salt__=salt_functions)
+
+	if url is not None:
+		for loaded in (utils, module):
+			point_at(loaded, url)
+
+	return utils_functions, salt_functions, states
+
+
+
+def point_at(module, url):
+	"""
+	Send the requests a loaded module makes to the API hosts to ``url``
+	instead
+	"""
+	for key, value in list(vars(module).items()):
+		if isinstance(value, str):
+			for host in API_HOSTS:
+				if value.startswith(host):
+					setattr(module, key, url + value[len(host):])
+
+
+
+def device_listing(count):
+	"""
+	A device listing response like rapyuta.io's with ``count`` devices
+	"""
+	return {
+		"response": {
+			"data": [
+				{
+					"uuid": "device-{0:08d}".format(i),
+					"name": "robot{0}".format(i),
+					"status": "ONLINE" if i % 7 else "OFFLINE",
+					"labels": [
+						{"id": i * 2, "key": "site", "value": "site{0}".format(i % 20)},
+						{"id": i * 2 + 1, "key": "fleet", "value": "fleet{0}".format(i % 3)},
+					],
+					"config_variables": [
+						{"id": i, "key": "runtime", "value": "dockercompose"},
+						{"id": i, "key": "ros_distro", "value": "melodic"},
+					],
+					"host": "robot{0}".format(i),
+					"ip_interfaces": {"eth0": ["10.0.{0}.{1}".format(i // 250, i % 250)]},
+					"saltversion": "3004",
+				}
+				for i
+				in range(count)
+			]
+		}
+	}
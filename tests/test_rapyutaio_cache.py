@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+The listing cache shared by the job processes forked from a proxy
+"""
+import json
+import os
+
+
+
+def in_child(fn):
+	"""
+	Run ``fn`` in a forked child process, as Salt runs a job, and return
+	what it returned
+	"""
+	read_fd, write_fd = os.pipe()
+	pid = os.fork()
+
+	if pid == 0:
+		try:
+			os.close(read_fd)
+			os.write(write_fd, json.dumps(fn()).encode("utf-8"))
+		finally:
+			os._exit(0)
+
+	os.close(write_fd)
+	with os.fdopen(read_fd) as _f:
+		result = _f.read()
+	os.waitpid(pid, 0)
+	return json.loads(result)
+
+
+
+def test_invalidation_by_another_job_is_seen(utils, server):
+	listing = []
+	server.routes["/deployment/list"] = lambda: listing
+	url = server.url + "/deployment/list"
+
+	# The proxy warms the cache before it forks jobs
+	assert utils.api_request(url, cache="deployments") == []
+
+	listing.append({"name": "d0"})
+	in_child(lambda: utils.cache_invalidate("deployments"))
+
+	assert in_child(lambda: utils.api_request(url, cache="deployments")) == [{"name": "d0"}]
+	assert server.hits["/deployment/list"] == 2
+
+
+
+def test_listing_fetched_by_another_job_is_seen(utils, server):
+	listing = []
+	server.routes["/deployment/list"] = lambda: listing
+	url = server.url + "/deployment/list"
+
+	assert utils.api_request(url, cache="deployments") == []
+
+	listing.append({"name": "d0"})
+	in_child(lambda: (utils.cache_invalidate("deployments"),
+	                  utils.api_request(url, cache="deployments")))
+
+	assert utils.api_request(url, cache="deployments") == [{"name": "d0"}]
+	assert server.hits["/deployment/list"] == 2
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+Stress the rapyutaio client and device matcher from many threads at once,
+as Salt's parallel states do, against the local stand-in server
+"""
+import concurrent.futures
+import threading
+import time
+import standin
+
+
+
+THREADS = 32
+
+
+
+def run_together(fn, args):
+	"""
+	Call ``fn`` with each of ``args`` from its own thread, all released at
+	the same moment, and return the results in order
+	"""
+	barrier = threading.Barrier(len(args))
+
+	def call(arg):
+		barrier.wait()
+		return fn(arg)
+
+	with concurrent.futures.ThreadPoolExecutor(max_workers=len(args)) as executor:
+		return list(executor.map(call, args))
+
+
+
+def test_concurrent_match(utils):
+	devices = standin.device_listing(THREADS)['response']['data']
+	opts_before = dict(utils.__opts__)
+
+	matched = run_together(
+		lambda device: (device['name'], utils.match("G@labels:fleet:fleet1 and robot*", device)),
+		devices * 4
+	)
+
+	for name, result in matched:
+		assert result == (int(name[len("robot"):]) % 3 == 1)
+	assert utils.__opts__ == opts_before
+
+
+
+def test_concurrent_get_is_sent_once(utils, server):
+	server.routes["/slow"] = {"ok": True}
+	server.delay = 0.5
+
+	responses = run_together(
+		lambda _: utils.api_request(server.url + "/slow", params={"a": 1}),
+		range(THREADS)
+	)
+
+	assert server.hits["/slow"] == 1
+	assert all(response is responses[0] for response in responses)
+	assert responses[0] == {"ok": True}
+	assert not utils.IN_FLIGHT
+
+
+
+def test_different_gets_are_not_coalesced(utils, server):
+	server.routes["/slow"] = {"ok": True}
+	server.delay = 0.2
+
+	run_together(
+		lambda i: utils.api_request(server.url + "/slow", params={"page": i}),
+		range(4)
+	)
+
+	assert server.hits["/slow"] == 4
+
+
+
+def test_writes_are_not_coalesced(utils, server):
+	server.routes["/slow"] = {"ok": True}
+	server.delay = 0.2
+
+	run_together(
+		lambda _: utils.api_request(server.url + "/slow", http_method="POST", data={}),
+		range(4)
+	)
+
+	assert server.hits["/slow"] == 4
+
+
+
+def test_header_dict_is_copied(utils, server):
+	server.routes["/echo"] = {"ok": True}
+	header_dict = {"accept": "application/json"}
+
+	run_together(
+		lambda _: utils._send_request(server.url + "/echo",
+		                              header_dict=header_dict,
+		                              method="POST",
+		                              data={"a": 1}),
+		range(THREADS)
+	)
+	utils._query(server.url + "/echo", header_dict)
+
+	assert header_dict == {"accept": "application/json"}
+
+
+
+def test_waiter_retries_after_leader_deadline(utils, server):
+	server.routes["/slow"] = {"ok": True}
+	server.delay = 0.5
+	url = server.url + "/slow"
+
+	def call(i):
+		if i == 0:
+			with utils.deadline(0.2):
+				try:
+					return utils.api_request(url)
+				except utils.CommandExecutionError as e:
+					return e.info['status']
+		# Join the leader's request once it is in flight
+		time.sleep(0.05)
+		return utils.api_request(url)
+
+	assert run_together(call, range(2)) == [408, {"ok": True}]
+	assert server.hits["/slow"] == 2
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+"""
+States and requests bounded by a deadline, against a slow stand-in server
+"""
+import pytest
+import standin
+from salt.exceptions import CommandExecutionError
+
+
+
+@pytest.fixture
+def states(utils, server):
+	_, _, states = standin.load_salt_modules(utils, server.url)
+	return states
+
+
+
+def test_request_cut_short_is_tagged(utils, server):
+	server.routes["/slow"] = {"ok": True}
+	server.delay = 1
+
+	with utils.deadline(0.2):
+		with pytest.raises(CommandExecutionError) as excinfo:
+			utils.api_request(server.url + "/slow")
+
+	assert excinfo.value.info['status'] == 408
+
+
+
+def test_package_present_fails_at_deadline(states, server):
+	server.routes["/v2/catalog"] = {
+		"services": [
+			{"name": "talker", "id": "pkg-1", "metadata": {"packageVersion": "v1.0"}},
+		],
+	}
+	server.delay = 1
+
+	ret = states.package_present("talker",
+	                             contents={"name": "talker", "packageVersion": "v1.0"},
+	                             deadline=0.2)
+
+	assert ret['result'] is False
+	assert "Deadline exceeded" in ret['comment']
+	assert not server.hits["/serviceclass/add"]
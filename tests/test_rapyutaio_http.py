@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+"""
+The HTTP client requests are sent with, and the minion options it honours
+"""
+import pytest
+import standin
+
+
+
+def test_salt_is_the_default_backend(tmp_path):
+	utils = standin.load_utils(str(tmp_path))
+	utils.__salt__ = {"config.get": lambda key, default=None: default}
+
+	assert utils._http_backend() == "salt"
+
+
+
+def test_aiohttp_goes_through_the_proxy(utils, server):
+	if utils._http_backend() != "aiohttp":
+		pytest.skip("Salt's HTTP client handles its own proxy options")
+	host, port = server.server_address
+	utils.__opts__.update(proxy_host=host, proxy_port=port)
+	server.routes["http://rapyuta.invalid/devices/"] = {"ok": True}
+
+	assert utils.api_request("http://rapyuta.invalid/devices/") == {"ok": True}
+
+	utils.__opts__['no_proxy'] = ["rapyuta.invalid"]
+	assert utils._async_proxy("http://rapyuta.invalid/devices/") is None
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+"""
+Planning package uploads against the catalog of the stand-in server
+"""
+import pytest
+import standin
+from salt.exceptions import CommandExecutionError
+
+
+
+@pytest.fixture
+def salt_functions(utils, server):
+	server.routes["/v2/catalog"] = {
+		"services": [
+			{"name": "talker", "id": "pkg-1", "metadata": {"packageVersion": "v1.0"}},
+		],
+	}
+	_, salt_functions, _ = standin.load_salt_modules(utils, server.url)
+	return salt_functions
+
+
+
+def test_plan_fails_without_existing_manifest(salt_functions, server):
+	with pytest.raises(CommandExecutionError) as excinfo:
+		salt_functions['rapyutaio.plan_packages']([
+			{"name": "talker", "packageVersion": "v1.0"},
+			{"name": "listener", "packageVersion": "v1.0"},
+		])
+
+	assert "'talker v1.0'" in str(excinfo.value)
+	assert not server.hits["/serviceclass/add"]
+
+
+
+def test_plan_fails_on_duplicate_manifests(salt_functions):
+	with pytest.raises(CommandExecutionError) as excinfo:
+		salt_functions['rapyutaio.plan_packages']([
+			{"name": "listener", "packageVersion": "v1.0"},
+			{"name": "listener", "packageVersion": "v1.0", "description": "other"},
+		])
+
+	assert "'listener v1.0'" in str(excinfo.value)
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+"""
+Renewing the auth token shared by the job processes of a proxy
+"""
+import time
+import pytest
+
+
+
+@pytest.fixture
+def sdb(utils, monkeypatch):
+	stored = {}
+	monkeypatch.setattr(utils.salt.utils.sdb,
+	                    "sdb_get",
+	                    lambda uri, opts, profile=None: stored.get(uri))
+
+	def login(username, password):
+		raise AssertionError("logged in again")
+
+	monkeypatch.setattr(utils, "get_auth_token", login)
+	monkeypatch.setattr(utils, "get_credentials", lambda: ("user", "password"))
+	return stored
+
+
+
+def test_token_renewed_by_another_process_is_reused(utils, sdb):
+	now = time.time()
+	utils.TOKEN['current'] = {"token": "rejected", "issuedAt": now - 60, "renewAt": now + 3600}
+	sdb['sdb://rapyutaio/auth_token'] = {"token": "renewed", "issuedAt": now - 1, "renewAt": now + 3600}
+
+	assert utils._renew_token(rejected_token="rejected")['token'] == "renewed"
+	assert utils.TOKEN['current']['token'] == "renewed"
+
+
+
+def test_older_token_is_not_reused(utils, sdb):
+	now = time.time()
+	utils.TOKEN['current'] = {"token": "rejected", "issuedAt": now - 1, "renewAt": now + 3600}
+	sdb['sdb://rapyutaio/auth_token'] = {"token": "older", "issuedAt": now - 60, "renewAt": now + 3600}
+
+	with pytest.raises(AssertionError, match="logged in again"):
+		utils._renew_token(rejected_token="rejected")